@@ -0,0 +1,629 @@
+# Нагрузочный тест vk-messager без обращения к настоящим VK и OpenAI.
+# Тестовые серверы VK API, Bots Long Poll и OpenAI работают в отдельном процессе и сами создают поток
+# входящих сообщений; бот запускается через main() из vk-messager.py в этом процессе, как при обычном
+# запуске с --all. Результат — пропускная способность, задержка ответа, число вызовов API на сообщение,
+# память и время до первого опроса LongPoll; его можно сохранить в JSON и сравнить с прошлым запуском.
+#
+# Пример:
+#   python benchmark.py --duration 60 --peers 200 --rate 20 --output run.json
+#   python benchmark.py --duration 60 --peers 200 --rate 20 --baseline run.json
+
+import os
+import re
+import sys
+import json
+import time
+import heapq
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import configparser
+import importlib.util
+import multiprocessing
+import urllib.request
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+BOT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "vk-messager.py")
+GROUP_ID_BASE = 100000
+USER_ID_BASE = 1000000
+CHAT_PEER_BASE = 2000000000
+
+# Типовые вопросы покупателей; часть с номерами, чтобы вопросы не совпадали дословно
+QUESTIONS = [
+    "Здравствуйте! Сколько стоит доставка?",
+    "Есть в наличии размер M?",
+    "Какие сроки доставки в Москву?",
+    "Можно оплатить картой при получении?",
+    "Добрый день, а скидки сейчас есть?",
+    "Заказ №{n} когда придёт?",
+    "Сколько стоит товар {n}?",
+    "Подскажите, работаете в выходные?",
+]
+
+# Сравниваемые показатели: имя и True, если больше — лучше
+COMPARED = [
+    ("throughput", True),
+    ("latency_p50", False),
+    ("latency_p99", False),
+    ("vk_calls_per_message", False),
+    ("openai_calls_per_message", False),
+    ("memory_peak_mb", False),
+    ("startup_seconds", False),
+]
+
+class VkError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+# Тестовые VK API, Bots Long Poll и OpenAI с задержками, ограничением частоты и ошибками
+class FakeServices:
+    def __init__(self, options):
+        self.options = options
+        self.random = random.Random(options["seed"])
+        self.condition = threading.Condition()
+        self.groups = [GROUP_ID_BASE + idx for idx in range(options["sessions"])]
+        self.updates = {group_id: [] for group_id in self.groups}  # события Bots Long Poll по группам
+        self.history = {}       # (группа, peer_id) -> сообщения диалога
+        self.pending = {}       # (группа, peer_id) -> моменты отправки сообщений, ещё не получивших ответа
+        self.cmids = Counter()  # (группа, peer_id) -> последний conversation_message_id
+        self.next_message_id = 1
+        self.pts = 1
+        self.buckets = {}       # ключ доступа -> [токены, время последнего пополнения]
+        self.polled = set()
+        self.latencies = []
+        self.api_calls = Counter()
+        self.counters = Counter()
+        self.first_poll_at = None
+        self.traffic_started_at = None
+        self.traffic_done_at = None
+        self.last_reply_at = None
+
+    def _sleep(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * self.random.uniform(0.5, 1.5))
+
+    # Ограничение частоты по ключу доступа: True — запрос можно выполнить
+    def _allow(self, key, rate):
+        if not rate:
+            return True
+        with self.condition:
+            now = time.monotonic()
+            tokens, updated = self.buckets.get(key, (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self.buckets[key] = (tokens - 1 if allowed else tokens, now)
+            return allowed
+
+    def _inject_error(self):
+        return self.options["error_rate"] and self.random.random() < self.options["error_rate"]
+
+    # Входящее сообщение собеседника: событие message_new и запись в историю
+    def inject(self, group_id, peer_id, from_id, text):
+        with self.condition:
+            key = (group_id, peer_id)
+            self.cmids[key] += 1
+            # В беседах сообщество без доступа к переписке получает id = 0
+            message_id = 0 if peer_id >= CHAT_PEER_BASE else self.next_message_id
+            self.next_message_id += 1
+            self.pts += 1
+            message = {"id": message_id, "conversation_message_id": self.cmids[key], "peer_id": peer_id, "from_id": from_id,
+                       "date": int(time.time()), "text": text, "out": 0, "attachments": [], "fwd_messages": []}
+            self.history.setdefault(key, []).append(message)
+            self.updates[group_id].append({"type": "message_new", "group_id": group_id,
+                                           "object": {"message": message, "client_info": {}}})
+            self.pending.setdefault(key, deque()).append(time.time())
+            self.counters["inbound"] += 1
+            self.condition.notify_all()
+
+    def _reply(self, group_id, peer_id, text):
+        now = time.time()
+        with self.condition:
+            key = (group_id, peer_id)
+            self.cmids[key] += 1
+            message_id = self.next_message_id
+            self.next_message_id += 1
+            self.pts += 1
+            message = {"id": message_id, "conversation_message_id": self.cmids[key], "peer_id": peer_id, "from_id": -group_id,
+                       "date": int(now), "text": text, "out": 1}
+            self.history.setdefault(key, []).append(message)
+            self.updates[group_id].append({"type": "message_reply", "group_id": group_id, "object": message})
+            pending = self.pending.get(key) or ()
+            self.latencies.extend(now - sent_at for sent_at in pending)
+            self.counters["answered"] += len(pending)
+            self.counters["replies"] += 1
+            self.pending[key] = deque()
+            self.last_reply_at = now
+            self.condition.notify_all()
+        return message_id
+
+    def vk_method(self, method, params):
+        self.api_calls[method] += 1
+        self._sleep(self.options["vk_latency"])
+        if self._inject_error():
+            self.counters["vk_errors"] += 1
+            raise VkError(10, "Internal server error: benchmark injected error")
+        group_id = int(params.get("group_id") or 0)
+        if method == "groups.getById":
+            return [{"id": group_id, "name": f"Тестовая группа {group_id}", "screen_name": f"club{group_id}", "description": ""}]
+        if method == "groups.getLongPollServer":
+            with self.condition:
+                return {"server": f"{self.base_url}/lp/{group_id}", "key": "bench", "ts": str(len(self.updates[group_id]))}
+        if method == "messages.getLongPollServer":
+            return {"server": "127.0.0.1/unused", "key": "bench", "ts": "0", "pts": self.pts}
+        if method == "messages.getLongPollHistory":
+            return {"history": [], "messages": {"count": 0, "items": []}, "profiles": [], "new_pts": self.pts}
+        if method == "users.get":
+            return [{"id": int(user_id), "first_name": f"Покупатель{int(user_id) - USER_ID_BASE}", "last_name": "Тестов",
+                     "can_write_private_message": 1, "city": {"id": 1, "title": "Москва"}, "sex": 2}
+                    for user_id in str(params.get("user_ids", "")).split(",") if user_id]
+        if method == "messages.getChat":
+            chat_peer = CHAT_PEER_BASE + int(params["chat_id"])
+            with self.condition:
+                members = {message["from_id"] for (_, peer_id), messages in self.history.items()
+                           if peer_id == chat_peer for message in messages}
+            return {"id": int(params["chat_id"]), "title": "Тестовая беседа",
+                    "members": [{"member_id": member_id} for member_id in members | {-group_id}]}
+        if method == "messages.getHistory":
+            with self.condition:
+                messages = list(self.history.get((group_id, int(params["peer_id"])), []))
+            count = int(params.get("count", 20))
+            return {"count": len(messages), "items": messages[::-1][:count]}
+        if method == "messages.send":
+            return self._reply(group_id, int(params["peer_id"]), params.get("message", ""))
+        if method in ("messages.setActivity", "account.setOnline"):
+            return 1
+        raise VkError(3, f"Unknown method passed: {method}")
+
+    # Код execute из VkBatcher: return [API.метод({...}),...];
+    def vk_execute(self, code):
+        calls = []
+        decoder = json.JSONDecoder()
+        position = code.index("[") + 1
+        call_start = re.compile(r"\s*API\.([\w.]+)\(")
+        while True:
+            match = call_start.match(code, position)
+            if not match:
+                break
+            params, position = decoder.raw_decode(code, match.end())
+            position = code.index(")", position) + 1
+            calls.append((match.group(1), params))
+            if code[position:position + 1] == ",":
+                position += 1
+        results, errors = [], []
+        for method, params in calls:
+            try:
+                results.append(self.vk_method(method, params))
+            except VkError as e:
+                results.append(False)
+                errors.append({"method": method, "error_code": e.code, "error_msg": e.message})
+        response = {"response": results}
+        if errors:
+            response["execute_errors"] = errors
+        return response
+
+    def vk_request(self, method, params):
+        self.counters["vk_requests"] += 1
+        if not self._allow(("vk", params.get("access_token")), self.options["vk_rps"]):
+            self.counters["vk_rate_limited"] += 1
+            return {"error": {"error_code": 6, "error_msg": "Too many requests per second", "request_params": []}}
+        try:
+            if method == "execute":
+                self.api_calls["execute"] += 1
+                return self.vk_execute(params["code"])
+            return {"response": self.vk_method(method, params)}
+        except VkError as e:
+            return {"error": {"error_code": e.code, "error_msg": e.message, "request_params": []}}
+
+    def longpoll(self, group_id, ts, wait):
+        with self.condition:
+            if group_id not in self.polled:
+                self.polled.add(group_id)
+                self.first_poll_at = self.first_poll_at or time.time()
+                self.condition.notify_all()
+            self.condition.wait_for(lambda: len(self.updates[group_id]) > ts, timeout=wait)
+            updates = self.updates[group_id][ts:]
+            return {"ts": str(ts + len(updates)), "updates": updates}
+
+    # Ответ OpenAI: (код, заголовки, тело) либо поток частей для stream=True
+    def completion(self, body):
+        self.counters["openai_requests"] += 1
+        if not self._allow("openai", self.options["openai_rpm"] / 60):
+            self.counters["openai_rate_limited"] += 1
+            return 429, {"retry-after": "1"}, {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+        if self._inject_error():
+            self.counters["openai_errors"] += 1
+            return 500, {}, {"error": {"message": "benchmark injected error", "type": "server_error"}}
+        words = [f"ответ{idx}" for idx in range(self.options["reply_words"])]
+        prompt_tokens = sum(len(message.get("content") or "") for message in body.get("messages", [])) // 4 + 1
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(words), "total_tokens": prompt_tokens + len(words)}
+        created = int(time.time())
+        self._sleep(self.options["openai_ttft"])
+        if not body.get("stream"):
+            self._sleep(self.options["openai_token_delay"] * len(words))
+            return 200, {}, {"id": "chatcmpl-bench", "object": "chat.completion", "created": created, "model": body.get("model"),
+                             "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words) + "."},
+                                          "finish_reason": "stop"}], "usage": usage}
+
+        def chunks():
+            for idx, word in enumerate(words):
+                if idx:
+                    self._sleep(self.options["openai_token_delay"])
+                content = word + ("." if idx == len(words) - 1 else " ")
+                yield {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                       "choices": [{"index": 0, "delta": {"content": content}, "finish_reason": None}]}
+            yield {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                   "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield {"id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": created, "model": body.get("model"),
+                       "choices": [], "usage": usage}
+        return 200, {}, chunks()
+
+    # Поток сообщений: начинается, когда все группы впервые опросили Long Poll, и идёт options["duration"] секунд
+    def run_traffic(self):
+        options = self.options
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.polled) == len(self.groups))
+        self.traffic_started_at = time.time()
+        end = self.traffic_started_at + options["duration"]
+        scheduled = []  # куча (момент, порядковый номер, группа, peer_id, отправитель)
+        sequence = 0
+        next_arrival = time.time()
+        while True:
+            now = time.time()
+            while next_arrival <= now and next_arrival < end:
+                group_id = self.random.choice(self.groups)
+                user_id = USER_ID_BASE + self.random.randrange(options["peers"])
+                in_chat = options["chats"] and self.random.random() < options["chat_share"]
+                peer_id = CHAT_PEER_BASE + 1 + self.random.randrange(options["chats"]) if in_chat else user_id
+                burst = options["burst_size"] if self.random.random() < options["burst_prob"] else 1
+                for idx in range(burst):
+                    heapq.heappush(scheduled, (next_arrival + idx * options["burst_gap"], sequence, group_id, peer_id, user_id))
+                    sequence += 1
+                next_arrival += self.random.expovariate(options["rate"])
+            while scheduled and scheduled[0][0] <= now:
+                _, _, group_id, peer_id, user_id = heapq.heappop(scheduled)
+                self.inject(group_id, peer_id, user_id, self.random.choice(QUESTIONS).format(n=self.random.randrange(1000)))
+            if next_arrival >= end and not scheduled:
+                break
+            upcoming = min(next_arrival, scheduled[0][0]) if scheduled else next_arrival
+            time.sleep(max(0, min(upcoming - time.time(), 0.05)))
+        self.traffic_done_at = time.time()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "counters": dict(self.counters),
+                "api_calls": dict(self.api_calls),
+                "latencies": list(self.latencies),
+                "unanswered": sum(len(pending) for pending in self.pending.values()),
+                "first_poll_at": self.first_poll_at,
+                "traffic_started_at": self.traffic_started_at,
+                "traffic_done_at": self.traffic_done_at,
+                "last_reply_at": self.last_reply_at,
+            }
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200, headers=None):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, chunks):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            self._write_chunk(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0))
+
+    def do_GET(self):
+        services = self.server.services
+        url = urlparse(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        if url.path.startswith("/lp/"):
+            self._send_json(services.longpoll(int(url.path.rsplit("/", 1)[1]), int(query.get("ts", 0)), float(query.get("wait", 25))))
+        elif url.path == "/_bench/stats":
+            self._send_json(services.stats())
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        services = self.server.services
+        url = urlparse(self.path)
+        body = self._body()
+        if url.path.startswith("/method/"):
+            params = {key: values[-1] for key, values in parse_qs(body.decode("utf-8"), keep_blank_values=True).items()}
+            self._send_json(services.vk_request(url.path[len("/method/"):], params))
+        elif url.path == "/v1/chat/completions":
+            status, headers, data = services.completion(json.loads(body or b"{}"))
+            if isinstance(data, dict):
+                self._send_json(data, status, headers)
+            else:
+                self._send_stream(data)
+        else:
+            self.send_error(404)
+
+# Процесс тестовых серверов: сообщает порт родителю и обслуживает запросы, пока его не остановят
+def serve_fake_services(options, connection):
+    services = FakeServices(options)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FakeHandler)
+    server.daemon_threads = True
+    server.services = services
+    services.base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=services.run_traffic, daemon=True).start()
+    connection.send(server.server_address[1])
+    server.serve_forever()
+
+# vk-messager.py загружается по пути: в имени файла есть дефис, обычный import его не найдёт
+def load_bot():
+    spec = importlib.util.spec_from_file_location("vk_messager", BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def write_sessions(args):
+    os.makedirs("Sessions", exist_ok=True)
+    for idx in range(args.sessions):
+        group_id = GROUP_ID_BASE + idx
+        config = configparser.ConfigParser()
+        config["DEFAULT"] = {
+            "vk-token": f"bench-token-{group_id}",
+            "openai-token": "bench-openai-token",
+            "group-id": str(group_id),
+            "group-name": f"Тестовая группа {group_id}",
+            "group-description": "",
+            "personality": "Вежливый консультант интернет-магазина",
+            "commercial-info": "Магазин одежды, доставка по России от 300 рублей",
+            "conversation-rules": "Отвечай коротко и по делу",
+            "conversation-goal": "Помочь оформить заказ",
+            "reply-cache": "yes" if args.reply_cache else "no",
+        }
+        with open(os.path.join("Sessions", f"group_{group_id}_bench.ini"), "w", encoding="utf-8") as file:
+            config.write(file)
+
+# Настройки бота на время теста: адреса тестовых серверов и без искусственных пауз «печати»
+def configure_bot(bot, args, base_url):
+    bot.VK_API_URL = f"{base_url}/method/"
+    bot.OPENAI_BASE_URL = f"{base_url}/v1"
+    bot.TYPING_CHARS_PER_SECOND = 10 ** 6
+    bot.COALESCE_QUIET_PERIOD = args.quiet_period
+    bot.COALESCE_MAX_WAIT = max(args.quiet_period * 5, 1)
+    bot.OPENAI_STREAMING = not args.no_streaming
+    bot.STATS_INTERVAL = 0
+    bot.METRICS_PORT = 0
+    bot.REPORTS_EXPORT_INTERVAL = 0
+
+# Запросы бота за пределы тестовых серверов: при первом же таком запросе тест прерывается
+offline_violations = []
+
+def check_offline(url):
+    host = urlparse(str(url)).hostname
+    if host != "127.0.0.1":
+        offline_violations.append(str(url))
+        raise RuntimeError(f"benchmark: запрос не к тестовому серверу: {url}")
+
+# Все HTTP-запросы бота проверяются перед отправкой: requests — на уровне транспортного адаптера
+# (после подмены адреса VK API), клиент OpenAI (httpx) — через обработчик событий запроса
+def guard_offline(bot):
+    adapter_send = bot.requests.adapters.HTTPAdapter.send
+
+    def offline_send(adapter, request, *args, **kwargs):
+        check_offline(request.url)
+        return adapter_send(adapter, request, *args, **kwargs)
+    bot.requests.adapters.HTTPAdapter.send = offline_send
+
+    make_openai_client = bot.get_openai_http_client
+
+    def offline_openai_client():
+        client = make_openai_client()
+        hooks = client.event_hooks["request"]
+        if offline_request_hook not in hooks:
+            hooks.append(offline_request_hook)
+        return client
+    bot.get_openai_http_client = offline_openai_client
+
+def offline_request_hook(request):
+    check_offline(request.url)
+
+# Текущий объём памяти процесса, МБ
+def memory_mb():
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except OSError:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 2 ** 10
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+def fetch_stats(base_url):
+    with urllib.request.urlopen(f"{base_url}/_bench/stats", timeout=10) as response:
+        return json.load(response)
+
+def build_report(args, stats, samples, started):
+    counters = stats["counters"]
+    answered = counters.get("answered", 0)
+    latencies = stats["latencies"]
+    active = (stats["last_reply_at"] or time.time()) - (stats["traffic_started_at"] or started)
+    vk_calls = sum(count for method, count in stats["api_calls"].items() if method != "execute")
+    per_message = (lambda value: round(value / answered, 3) if answered else None)
+    return {
+        "options": {key: value for key, value in vars(args).items() if key not in ("output", "baseline", "verbose", "keep")},
+        "startup_seconds": round(stats["first_poll_at"] - started, 3) if stats["first_poll_at"] else None,
+        "messages": counters.get("inbound", 0),
+        "answered": answered,
+        "unanswered": stats["unanswered"],
+        "replies": counters.get("replies", 0),
+        "throughput": round(answered / active, 3) if answered and active > 0 else 0,
+        "latency_mean": round(sum(latencies) / len(latencies), 3) if latencies else None,
+        "latency_p50": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "latency_p99": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "latency_max": round(max(latencies), 3) if latencies else None,
+        "vk_calls_per_message": per_message(vk_calls),
+        "vk_requests_per_message": per_message(counters.get("vk_requests", 0)),
+        "openai_calls_per_message": per_message(counters.get("openai_requests", 0)),
+        "api_calls": stats["api_calls"],
+        "errors": {key: value for key, value in counters.items() if key.endswith(("_errors", "_rate_limited"))},
+        "memory_peak_mb": round(max(mb for _, mb in samples), 1) if samples else None,
+        "memory_mb": [[round(elapsed, 1), round(mb, 1)] for elapsed, mb in samples],
+    }
+
+# Сравнение с прошлым запуском: строки таблицы и признак регрессии сверх допуска
+def compare(report, baseline, tolerance):
+    lines = [f"{'показатель':<26}{'было':>12}{'стало':>12}{'изменение':>12}"]
+    regression = False
+    for name, higher_is_better in COMPARED:
+        old, new = baseline.get(name), report.get(name)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0
+        worse = -change if higher_is_better else change
+        mark = ""
+        if worse > tolerance:
+            mark = "  регрессия"
+            regression = True
+        lines.append(f"{name:<26}{old:>12}{new:>12}{change:>+12.1%}{mark}")
+    return lines, regression
+
+def print_report(report):
+    print(f"Время до первого опроса LongPoll: {report['startup_seconds']} с", file=sys.stderr)
+    print(f"Сообщений: {report['messages']}, отвечено: {report['answered']} ({report['replies']} ответов), "
+          f"без ответа: {report['unanswered']}", file=sys.stderr)
+    print(f"Пропускная способность: {report['throughput']} сообщ./с", file=sys.stderr)
+    print(f"Задержка ответа: p50 {report['latency_p50']} с, p99 {report['latency_p99']} с, максимум {report['latency_max']} с",
+          file=sys.stderr)
+    print(f"На сообщение: вызовов VK API {report['vk_calls_per_message']}, HTTP-запросов к VK {report['vk_requests_per_message']}, "
+          f"запросов OpenAI {report['openai_calls_per_message']}", file=sys.stderr)
+    print(f"Память: пик {report['memory_peak_mb']} МБ", file=sys.stderr)
+    if report["errors"]:
+        print("Ошибки и ограничения: " + ", ".join(f"{key} {value}" for key, value in report["errors"].items()), file=sys.stderr)
+
+def run(args):
+    mp = multiprocessing.get_context("spawn")
+    parent_connection, child_connection = mp.Pipe()
+    options = {key: getattr(args, key) for key in (
+        "sessions", "peers", "chats", "chat_share", "rate", "burst_prob", "burst_size", "burst_gap", "duration",
+        "vk_latency", "vk_rps", "openai_ttft", "openai_token_delay", "openai_rpm", "reply_words", "error_rate", "seed")}
+    services = mp.Process(target=serve_fake_services, args=(options, child_connection), daemon=True)
+    services.start()
+    base_url = f"http://127.0.0.1:{parent_connection.recv()}"
+
+    workdir = tempfile.mkdtemp(prefix="vk-messager-bench-")
+    cwd = os.getcwd()
+    stdout = sys.stdout
+    os.chdir(workdir)
+    try:
+        write_sessions(args)
+        if not args.verbose:
+            sys.stdout = open(os.devnull, "w", encoding="utf-8")
+        started = time.time()
+        samples = [(0.0, memory_mb())]
+        bot = load_bot()
+        configure_bot(bot, args, base_url)
+        guard_offline(bot)
+        sys.argv = [BOT_PATH, "--all"]
+        threading.Thread(target=bot.main, name="bot", daemon=True).start()
+        while True:
+            time.sleep(args.sample_interval)
+            samples.append((time.time() - started, memory_mb()))
+            stats = fetch_stats(base_url)
+            if stats["traffic_done_at"] and (not stats["unanswered"] or time.time() > stats["traffic_done_at"] + args.drain):
+                break
+            if offline_violations:
+                raise RuntimeError(f"бот обратился не к тестовому серверу ({offline_violations[0]}), тест прерван")
+            if not stats["first_poll_at"] and time.time() - started > 60:
+                raise RuntimeError("бот не начал опрашивать Long Poll за 60 секунд")
+        return build_report(args, stats, samples, started)
+    finally:
+        if sys.stdout is not stdout:
+            sys.stdout.close()
+            sys.stdout = stdout
+        os.chdir(cwd)
+        services.terminate()
+        if args.keep:
+            print(f"Рабочая папка теста: {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест vk-messager на тестовых серверах VK и OpenAI")
+    traffic = parser.add_argument_group("поток сообщений")
+    traffic.add_argument("--sessions", type=int, default=1, help="число сессий групп")
+    traffic.add_argument("--peers", type=int, default=50, help="число собеседников")
+    traffic.add_argument("--chats", type=int, default=5, help="число бесед")
+    traffic.add_argument("--chat-share", type=float, default=0.1, help="доля сообщений из бесед")
+    traffic.add_argument("--rate", type=float, default=5, help="сообщений (серий) в секунду")
+    traffic.add_argument("--burst-prob", type=float, default=0.2, help="вероятность, что собеседник пишет серию сообщений")
+    traffic.add_argument("--burst-size", type=int, default=3, help="сообщений в серии")
+    traffic.add_argument("--burst-gap", type=float, default=0.3, help="пауза между сообщениями серии, секунд")
+    traffic.add_argument("--duration", type=float, default=30, help="длительность потока сообщений, секунд")
+    traffic.add_argument("--drain", type=float, default=30, help="сколько ждать ответов после конца потока, секунд")
+    traffic.add_argument("--seed", type=int, default=1)
+    servers = parser.add_argument_group("тестовые серверы")
+    servers.add_argument("--vk-latency", type=float, default=0.02, help="задержка ответа VK API, секунд")
+    servers.add_argument("--vk-rps", type=float, default=20, help="лимит VK API на ключ, запросов в секунду, 0 — без лимита")
+    servers.add_argument("--openai-ttft", type=float, default=0.3, help="задержка до первого токена OpenAI, секунд")
+    servers.add_argument("--openai-token-delay", type=float, default=0.01, help="пауза между токенами OpenAI, секунд")
+    servers.add_argument("--openai-rpm", type=float, default=0, help="лимит OpenAI, запросов в минуту, 0 — без лимита")
+    servers.add_argument("--reply-words", type=int, default=25, help="длина ответа OpenAI, слов")
+    servers.add_argument("--error-rate", type=float, default=0, help="доля запросов, завершающихся ошибкой")
+    bot = parser.add_argument_group("бот")
+    bot.add_argument("--quiet-period", type=float, default=0.5, help="COALESCE_QUIET_PERIOD на время теста")
+    bot.add_argument("--no-streaming", action="store_true", help="без потоковой генерации ответа")
+    bot.add_argument("--reply-cache", action="store_true", help="включить кэш ответов в сессиях")
+    output = parser.add_argument_group("результат")
+    output.add_argument("--output", help="сохранить результат в JSON")
+    output.add_argument("--baseline", help="сравнить с результатом прошлого запуска (JSON)")
+    output.add_argument("--tolerance", type=float, default=0.1, help="допустимое ухудшение показателя, доля")
+    output.add_argument("--sample-interval", type=float, default=1, help="период замера памяти, секунд")
+    output.add_argument("--keep", action="store_true", help="не удалять рабочую папку теста")
+    output.add_argument("--verbose", action="store_true", help="показывать вывод бота")
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, ensure_ascii=False, indent=2)
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as file:
+            lines, regression = compare(report, json.load(file), args.tolerance)
+        print("\n".join(lines), file=sys.stderr)
+        if regression:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
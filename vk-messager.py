@@ -1,53 +1,722 @@
 import os
+import csv
+import glob
 import json
 import unicodedata
 import vk_api
 import configparser
 import re
+import sys
+import hashlib
+import bisect
+import multiprocessing
+import argparse
+import random
+import html
+import sqlite3
+import atexit
 import requests
 from datetime import datetime
-from openai import OpenAI
 import time
 from requests.exceptions import ConnectionError, ReadTimeout
 import threading
-import openpyxl
-from openpyxl.utils import get_column_letter
+import queue
+import heapq
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from collections import deque, OrderedDict
+
+# openai, httpx и openpyxl импортируются при первом использовании: без них процесс запускается и начинает
+# опрашивать LongPoll быстрее, а openpyxl нужен только для выгрузки отчётов
+STARTED_AT = time.time()  # момент запуска процесса: от него считается время до первого опроса LongPoll
 
 # Настройка директорий
 SESSIONS_DIR = os.path.join(os.getcwd(), "Sessions")
 DOSSIER_DIR = os.path.join(os.getcwd(), "Dossier")
 REPORTS_FILE = "reports.xlsx"
+REPORTS_JOURNAL = "reports.csv"
+STORAGE_DB = "vk-messager.db"
 if not os.path.exists(SESSIONS_DIR):
     os.makedirs(SESSIONS_DIR)
 if not os.path.exists(DOSSIER_DIR):
     os.makedirs(DOSSIER_DIR)
 
-# Функция с логикой повторного запроса (для LongPoll и других HTTP-запросов)
-def retry_request(request_func, backoff_factor=1, timeout=30):
-    retries = 0
-    while True:
-        try:
-            return request_func(timeout=timeout)
-        except (ConnectionError, ReadTimeout) as e:
-            print(f"Ошибка соединения: {e}")
-            retries += 1
-            wait_time = min(backoff_factor * (2 ** retries), 60)
-            print(f"Попытка {retries}. Ожидание {wait_time} секунд перед повтором.")
+# Настройки параллельной обработки сообщений
+WORKER_THREADS = 8         # число потоков-обработчиков (одновременно обслуживаемых собеседников)
+MAX_PENDING_EVENTS = 1000  # общий предел необработанных событий в очередях
+PEER_QUEUE_LIMIT = 20      # предел очереди одного собеседника, старые события вытесняются
+SUBMIT_TIMEOUT = 5         # сколько секунд LongPoll-поток ждёт места в переполненной очереди
+COALESCE_QUIET_PERIOD = 3  # пауза в секундах, после которой серия сообщений собеседника считается законченной
+COALESCE_MAX_WAIT = 15     # дольше этого серия не копится, даже если собеседник продолжает писать
+
+# Настройки работы нескольких аккаунтов в одном процессе
+ACCOUNT_MAX_CONCURRENCY = 4     # сколько собеседников одного аккаунта обслуживается одновременно
+SESSIONS_RESCAN_INTERVAL = 30   # как часто проверять папку Sessions на новые, удалённые и изменённые сессии
+ONLINE_INTERVAL = 300           # как часто обновлять статус «онлайн» аккаунтов
+
+# Настройки режима с несколькими процессами (--processes)
+SHARD_VIRTUAL_NODES = 100       # точек на кольце консистентного хеширования на каждый процесс
+SHARD_CHECK_INTERVAL = 1        # как часто супервизор проверяет, живы ли процессы
+SHARD_MAX_RESTARTS = 5          # если процесс падает чаще этого за SHARD_RESTART_WINDOW секунд,
+SHARD_RESTART_WINDOW = 300      # его сессии перераспределяются между остальными процессами
+
+# Настройки пакетной отправки запросов VK API через execute
+VK_BATCH_ENABLED = True
+VK_BATCH_WINDOW = 0.005      # сколько секунд собирать запросы в пакет
+VK_BATCH_SIZE = 25           # предел VK: не более 25 обращений к API в одном execute
+VK_BATCH_CONCURRENCY = 3     # сколько пакетов одного аккаунта может выполняться одновременно
+VK_RPS_RETRIES = 3           # повторы при ошибке 6 VK API (слишком много запросов в секунду)
+VK_RPS_RETRY_DELAY = 0.5     # пауза перед таким повтором, секунд
+
+# Настройки HTTP-транспорта: постоянные соединения и тайм-ауты, общие для VK API, LongPoll и OpenAI
+HTTP_POOL_HOSTS = 10          # для скольких хостов держать отдельный пул соединений
+HTTP_POOL_MAXSIZE = 100       # постоянных соединений на хост: LongPoll-поток каждого аккаунта держит своё
+HTTP_CONNECT_TIMEOUT = 5      # тайм-аут установки соединения, секунд
+HTTP_READ_TIMEOUT = 30        # тайм-аут ответа VK API
+LONGPOLL_WAIT = 25            # сколько секунд сервер LongPoll держит запрос, если событий нет
+LONGPOLL_READ_TIMEOUT = LONGPOLL_WAIT + 10
+OPENAI_READ_TIMEOUT = 60      # тайм-аут ответа OpenAI; при потоковой генерации — между частями ответа
+OPENAI_MAX_CONNECTIONS = 20
+HTTP2_ENABLED = True          # HTTP/2 для OpenAI, если установлен пакет h2
+VK_DEFAULT_API_URL = "https://api.vk.com/method/"
+VK_API_URL = VK_DEFAULT_API_URL   # адрес VK API; другой — например, для тестовых серверов benchmark.py
+VK_API_URL_PATTERN = re.compile(r"^https?://api\.vk\.[a-z]+/method/")  # адреса, к которым обращается vk_api разных версий
+OPENAI_BASE_URL = None            # адрес OpenAI API, None — стандартный
+VK_RETRY_CODES = {1, 6, 10}   # ошибки VK API, после которых запрос стоит повторить: неизвестная, частота, внутренняя
+
+# Настройки метрик: длительность этапов обработки, очереди, вызовы API и ошибки
+METRICS_ENABLED = True
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9108           # страница /metrics в формате Prometheus, 0 — не открывать; процессы-исполнители — следующие порты
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)  # границы гистограмм, секунд
+
+# Настройки ограничения частоты запросов (token bucket), общие для всех потоков процесса
+RATE_LIMIT_ENABLED = True
+VK_USER_RPS = 3              # лимит VK для ключа пользователя, запросов в секунду
+VK_GROUP_RPS = 20            # лимит VK для ключа сообщества
+OPENAI_RPM = 500             # лимит OpenAI, запросов в минуту
+OPENAI_TPM = 200000          # лимит OpenAI, токенов в минуту
+# Приоритеты вызовов VK API: меньше — важнее. Вызовы с приоритетом PRIORITY_COSMETIC
+# при насыщении лимита не ждут, а отбрасываются.
+PRIORITY_SEND = 0
+PRIORITY_READ = 1
+PRIORITY_COSMETIC = 2
+VK_METHOD_PRIORITY = {
+    "messages.send": PRIORITY_SEND,
+    "messages.setActivity": PRIORITY_COSMETIC,
+    "account.setOnline": PRIORITY_COSMETIC,
+}
+
+# Настройки генерации ответа и имитации печати
+OPENAI_MODEL = "gpt-4o-mini"
+OPENAI_MAX_TOKENS = 150
+OPENAI_STREAMING = True           # получать ответ по частям и начинать «печатать» с первого токена
+TYPING_CHARS_PER_SECOND = 3       # скорость «печати»: время набора ответа = длина / скорость
+TYPING_REFRESH = 5                # как часто обновлять статус «печатает», секунд
+STREAM_SPLIT_MESSAGES = False     # отправлять длинный ответ несколькими сообщениями по границам предложений
+STREAM_SPLIT_MIN_CHARS = 120      # минимальная длина отдельного сообщения при разбиении
+SENTENCE_END = re.compile(r"[.!?…]+[)\"»]*\s+")
+
+# Настройки формирования промпта
+PROMPT_TOKEN_BUDGET = 3000        # предел входных токенов промпта; история добирается от новых сообщений к старым
+PROMPT_MESSAGE_MAX_CHARS = 1000   # сообщения истории длиннее этого обрезаются
+PROMPT_SUMMARY_ENABLED = False    # сворачивать не поместившуюся историю в краткое содержание, хранимое в досье
+PROMPT_SUMMARY_MAX_TOKENS = 300   # размер краткого содержания и резерв под него в бюджете
+DEBUG = False                     # подробный отладочный вывод (в том числе полные промпты)
+
+# Настройки журнала отчётов
+REPORTS_JOURNAL_MAX_BYTES = 50 * 1024 * 1024  # ротация журнала по размеру
+REPORTS_ROTATE_DAILY = True                   # ротация журнала при смене даты
+REPORTS_EXPORT_INTERVAL = 600                 # период фоновой выгрузки в reports.xlsx, 0 — только по команде
+REPORT_HEADERS = ["timestamp", "account_id", "account_name", "entity_type", "message", "recipient_id", "recipient_name", "tokens_in", "tokens_out", "tokens_total", "tokens_cost"]
+XLSX_MAX_ROWS = 1048576
+
+# Настройки хранилища досье и счётчиков токенов
+STORAGE_COMMIT_INTERVAL = 2  # не реже чем раз в столько секунд изменения фиксируются в базе
+STORAGE_COMMIT_EVERY = 100   # фиксация после такого числа изменений, не дожидаясь таймера
+
+# Настройки кэша профилей и участников бесед
+PROFILE_CACHE_SIZE = 5000    # сколько профилей держать в памяти
+PROFILE_CACHE_TTL = 600      # срок жизни профиля в кэше, секунд
+CHAT_CACHE_SIZE = 500
+CHAT_CACHE_TTL = 300
+STATS_INTERVAL = 600         # период вывода статистики кэшей и лимитов, 0 — не выводить
+
+# Настройки кэша истории переписки
+HISTORY_LIMIT = 200          # сколько последних сообщений диалога хранить и передавать в промпт
+HISTORY_CACHE_PEERS = 2000   # сколько диалогов держать в памяти, давно не активные вытесняются
+HISTORY_PERSIST = False      # сохранять историю в базу и поднимать её оттуда после перезапуска
+
+# Настройки кэша ответов на повторяющиеся вопросы; включается в сессии строкой reply-cache = yes
+REPLY_CACHE_SIZE = 1000       # сколько вопросов с ответами держать в памяти
+REPLY_CACHE_TTL = 86400       # срок жизни ответа в кэше, секунд
+REPLY_CACHE_THRESHOLD = 0.8   # минимальное сходство вопросов (0–1) для ответа из кэша; в сессии — reply-cache-threshold
+REPLY_CACHE_NGRAM = 3         # длина n-грамм символов, по которым сравниваются вопросы
+REPLY_CACHE_MAX_CHARS = 300   # более длинные сообщения — уже не типовой вопрос, их ответы не кэшируются
+REPLY_CACHE_MIN_WORDS = 3     # более короткие («да», «а сколько?») понятны только в контексте диалога, кэш для них не используется
+
+# Настройки восстановления после перезапуска
+CATCHUP_ENABLED = True           # догружать сообщения, пришедшие, пока аккаунт не опрашивался
+CATCHUP_RATE = 2                 # сколько пропущенных сообщений в секунду передавать в обработку
+CATCHUP_MAX_AGE = 86400          # на более старые пропущенные сообщения не отвечать, 0 — без ограничения
+CATCHUP_OVERLAP = 300            # сохранённый pts отстаёт на столько секунд: сообщения из очереди не теряются при сбое
+MESSAGE_CLAIM_TIMEOUT = 600      # незавершённая за это время обработка сообщения считается брошенной
+PROCESSED_RETENTION = 7 * 86400  # сколько хранить отметки об обработанных сообщениях
+# Полный набор полей профиля: запрашивается один раз и обслуживает все проверки и досье
+PROFILE_FIELDS = (
+    "activities, about, blacklisted, blacklisted_by_me, books, bdate, can_write_private_message, "
+    "career, city, contacts, education, followers_count, friend_status, home_town, interests, last_seen, movies, music, status"
+)
+DEFAULT_DOSSIER = {
+    "photo_description": "",
+    "characteristic": "",
+    "sale_status": "",
+    "profit": 0,
+    "api_token": "",
+    "token_added": "",
+    "token_status": "",
+    "contacts": ""
+}
+
+# Политика повторных запросов: сетевые ошибки и временные ошибки VK API (retry_codes) повторяются
+# с экспоненциальной паузой, остальные ошибки выбрасываются сразу. max_retries=None — повторять до успеха.
+# retry_any=True — повторять после любой ошибки.
+class RetryPolicy:
+    def __init__(self, max_retries=None, backoff_factor=1, max_wait=60, retry_codes=(), retry_any=False):
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.max_wait = max_wait
+        self.retry_codes = set(retry_codes)
+        self.retry_any = retry_any
+
+    def should_retry(self, error):
+        if self.retry_any or isinstance(error, (ConnectionError, ReadTimeout)):
+            return True
+        return isinstance(error, vk_api.exceptions.ApiError) and error.code in self.retry_codes
+
+    # Пауза перед повтором; True — пришёл сигнал остановки
+    @staticmethod
+    def _wait(wait_time, stopped):
+        if stopped is None:
             time.sleep(wait_time)
+            return False
+        return stopped.wait(wait_time)
+
+    # stopped — событие остановки: пауза прерывается, и call возвращает None без новых попыток.
+    # wait_first — пауза и перед первой попыткой, когда вызов сам начинается после ошибки.
+    def call(self, request_func, stopped=None, wait_first=False):
+        retries = 0
+        if wait_first:
+            retries = 1
+            wait_time = min(self.backoff_factor * 2, self.max_wait)
+            print(f"Ожидание {wait_time} секунд перед повтором.")
+            if self._wait(wait_time, stopped):
+                return None
+        while True:
+            try:
+                return request_func()
+            except Exception as e:
+                if not self.should_retry(e):
+                    raise
+                retries += 1
+                if self.max_retries is not None and retries >= self.max_retries:
+                    raise Exception(f"Не удалось выполнить запрос после {self.max_retries} попыток: {e}")
+                # Ошибка 6 (слишком много запросов в секунду) проходит за секунду, длинная пауза не нужна
+                wait_time = 1 if getattr(e, "code", None) == 6 else min(self.backoff_factor * (2 ** retries), self.max_wait)
+                attempts = f"{retries}/{self.max_retries}" if self.max_retries is not None else str(retries)
+                print(f"Ошибка запроса: {e}. Повторная попытка {attempts}. Ожидание {wait_time} секунд.")
+                if self._wait(wait_time, stopped):
+                    return None
+
+network_retry = RetryPolicy()                                    # LongPoll и чтение данных: до успеха
+vk_retry = RetryPolicy(max_retries=3, retry_codes=VK_RETRY_CODES)  # отправка сообщений и прочие вызовы VK API
+reconnect_retry = RetryPolicy(retry_any=True)                    # переподключение LongPoll: до успеха или остановки
+
+# HTTP-адаптер с пулом постоянных соединений и тайм-аутом по умолчанию: vk_api свой тайм-аут не передаёт
+class PooledHTTPAdapter(requests.adapters.HTTPAdapter):
+    def __init__(self, timeout, **kwargs):
+        self.timeout = timeout
+        super().__init__(**kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        # vk_api обращается к фиксированному адресу (api.vk.com или api.vk.ru, в зависимости от версии);
+        # при другом VK_API_URL запрос уходит туда
+        if VK_API_URL != VK_DEFAULT_API_URL:
+            request.url = VK_API_URL_PATTERN.sub(lambda match: VK_API_URL, request.url, count=1)
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+# Общая для всех аккаунтов HTTP-сессия: через неё идут запросы VK API (vk_api) и LongPoll
+http_adapter = PooledHTTPAdapter((HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT),
+                                 pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE)
+http_session = requests.Session()
+http_session.mount("https://", http_adapter)
+http_session.mount("http://", http_adapter)
+LONGPOLL_TIMEOUT = (HTTP_CONNECT_TIMEOUT, LONGPOLL_READ_TIMEOUT)
+
+openai_http_client = None
+
+# Общий HTTP-клиент для всех ключей OpenAI; HTTP/2 — если установлен пакет h2
+def get_openai_http_client():
+    global openai_http_client
+    if openai_http_client is None:
+        import httpx
+        http2 = False
+        if HTTP2_ENABLED:
+            try:
+                import h2  # noqa: F401
+                http2 = True
+            except ImportError:
+                pass
+        openai_http_client = httpx.Client(
+            http2=http2,
+            limits=httpx.Limits(max_connections=OPENAI_MAX_CONNECTIONS, max_keepalive_connections=OPENAI_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(OPENAI_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT))
+    return openai_http_client
+
+# Статистика переиспользования соединений: по каждому хосту — запросов и открытых для них новых соединений
+def transport_stats():
+    hosts = []
+    pools = http_adapter.poolmanager.pools
+    for key in list(pools.keys()):
+        pool = pools.get(key)
+        if pool is not None:
+            hosts.append({"host": pool.host, "requests": pool.num_requests, "connections": pool.num_connections})
+    # httpx не ведёт счётчиков, видно только число открытых соединений
+    openai_pool = getattr(getattr(openai_http_client, "_transport", None), "_pool", None)
+    return {"hosts": hosts, "openai_connections": len(getattr(openai_pool, "connections", []))}
+
+# Метрики процесса: гистограммы длительностей, счётчики и показатели (gauge), которые вычисляются
+# в момент выгрузки. При METRICS_ENABLED = False все методы сразу возвращаются.
+class Metrics:
+    def __init__(self, enabled=METRICS_ENABLED, buckets=METRICS_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self.histograms = {}  # (имя, метки) -> {"counts", "sum", "count"}
+        self.counters = {}    # (имя, метки) -> значение
+        self.gauges = {}      # (имя, метки) -> функция без аргументов
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            histogram["counts"][bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+
+    def inc(self, name, amount=1, **labels):
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def gauge(self, name, func, **labels):
+        if self.enabled:
+            with self.lock:
+                self.gauges[self._key(name, labels)] = func
+
+    # Замер этапа обработки: with metrics.span("history"): ...
+    def span(self, stage):
+        return Span(self, stage) if self.enabled else nullcontext()
+
+    # Верхняя граница корзины, в которую попадает доля q наблюдений
+    def quantile(self, histogram, q):
+        threshold = q * histogram["count"]
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), histogram["counts"]):
+            total += count
+            if total >= threshold:
+                return bound
+        return float("inf")
+
+    # Текстовый формат Prometheus
+    def render(self):
+        def labels_text(labels, extra=()):
+            pairs = [key + '="' + value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+                     for key, value in labels + tuple(extra)]
+            return "{" + ",".join(pairs) + "}" if pairs else ""
+
+        with self.lock:
+            histograms = {key: {**value, "counts": list(value["counts"])} for key, value in self.histograms.items()}
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        lines = []
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                lines.append(f"# TYPE vk_messager_{name} counter")
+                typed.add(name)
+            lines.append(f"vk_messager_{name}{labels_text(labels)} {value}")
+        for (name, labels), func in sorted(gauges.items(), key=lambda item: item[0]):
+            try:
+                value = func()
+            except Exception:
+                continue
+            if name not in typed:
+                lines.append(f"# TYPE vk_messager_{name} gauge")
+                typed.add(name)
+            lines.append(f"vk_messager_{name}{labels_text(labels)} {value}")
+        for (name, labels), histogram in sorted(histograms.items()):
+            if name not in typed:
+                lines.append(f"# TYPE vk_messager_{name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), histogram["counts"]):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"vk_messager_{name}_bucket{labels_text(labels, [('le', le)])} {cumulative}")
+            lines.append(f"vk_messager_{name}_sum{labels_text(labels)} {histogram['sum']}")
+            lines.append(f"vk_messager_{name}_count{labels_text(labels)} {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    # Краткая сводка для периодического вывода: этапы обработки и вызовы API с ошибками
+    def summary(self):
+        with self.lock:
+            stages = [(dict(labels).get("stage"), dict(value)) for (name, labels), value in self.histograms.items() if name == "stage_seconds"]
+            calls = {dict(labels)["method"]: value for (name, labels), value in self.counters.items() if name == "api_calls_total"}
+            errors = {}
+            for (name, labels), value in self.counters.items():
+                if name == "api_errors_total":
+                    method = dict(labels)["method"]
+                    errors[method] = errors.get(method, 0) + value
+        lines = []
+        for stage, histogram in sorted(stages, key=lambda item: -item[1]["sum"]):
+            lines.append(f"Этап {stage}: {histogram['count']} раз, в среднем {histogram['sum'] / histogram['count']:.3f} с, "
+                         f"p50 ≤ {self.quantile(histogram, 0.5)} с, p99 ≤ {self.quantile(histogram, 0.99)} с")
+        if calls:
+            lines.append("Вызовы API: " + ", ".join(
+                f"{method} {count}" + (f" (ошибок {errors[method]})" if errors.get(method) else "")
+                for method, count in sorted(calls.items(), key=lambda item: -item[1])))
+        return lines
+
+class Span:
+    __slots__ = ("metrics", "stage", "started")
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
 
-# Функция для повторных попыток VK API запросов (например, отправки сообщений)
-def retry_vk_request(request_func, max_retries=3, backoff_factor=1):
-    retries = 0
-    while retries < max_retries:
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe("stage_seconds", time.perf_counter() - self.started, stage=self.stage)
+
+metrics = Metrics()
+
+# Учёт вызова внешнего API: число, длительность и ошибки по методу
+def record_api_call(api, method, started, error=None):
+    metrics.inc("api_calls_total", api=api, method=method)
+    metrics.observe("api_seconds", time.perf_counter() - started, api=api, method=method)
+    if error is not None:
+        metrics.inc("api_errors_total", api=api, method=method, error=getattr(error, "code", None) or type(error).__name__)
+
+# Локальная страница метрик для Prometheus
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port):
+    try:
+        server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+    except OSError as e:
+        print(f"Не удалось открыть страницу метрик на порту {port}: {e}")
+        return None
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"Метрики доступны по адресу http://{METRICS_HOST}:{server.server_address[1]}/metrics")
+    return server
+
+# Вызов отброшен ограничителем частоты, потому что лимит исчерпан, а вызов второстепенный
+class RateLimitShed(Exception):
+    pass
+
+# Ограничитель частоты (token bucket) с очередью ожидающих по приоритету:
+# свободный токен получает самый приоритетный из ожидающих, при равенстве — пришедший раньше.
+class TokenBucket:
+    def __init__(self, name, rate, capacity):
+        self.name = name
+        self.rate = rate            # токенов в секунду
+        self.capacity = capacity    # наибольший запас токенов (допустимый всплеск)
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.condition = threading.Condition()
+        self.waiters = []           # куча (приоритет, порядковый номер)
+        self.sequence = 0
+        self.acquired = 0
+        self.waited = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+        self.rejected = {}          # приоритет -> число отброшенных вызовов
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Проверка для второстепенного вызова: если лимит насыщен, вызов учитывается как отброшенный
+    def should_shed(self, priority, amount=1):
+        with self.condition:
+            self._refill()
+            if self.waiters or self.tokens < min(amount, self.capacity):
+                self.rejected[priority] = self.rejected.get(priority, 0) + 1
+                return True
+            return False
+
+    # Получение amount токенов: ожидание своей очереди по приоритету. Второстепенные вызовы
+    # проверяются заранее через should_shed и при насыщении сюда не попадают.
+    def acquire(self, amount=1, priority=PRIORITY_READ):
+        amount = min(amount, self.capacity)
+        with self.condition:
+            self.sequence += 1
+            entry = (priority, self.sequence)
+            heapq.heappush(self.waiters, entry)
+            started = time.monotonic()
+            while True:
+                self._refill()
+                if self.waiters[0] == entry and self.tokens >= amount:
+                    heapq.heappop(self.waiters)
+                    self.tokens -= amount
+                    self.condition.notify_all()
+                    break
+                timeout = (amount - self.tokens) / self.rate if self.waiters[0] == entry else None
+                self.condition.wait(timeout)
+            waited = time.monotonic() - started
+            self.acquired += 1
+            if waited > 0.001:
+                self.waited += 1
+                self.wait_time += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    # Смена лимита на ходу: ожидающие вызовы пересчитывают время ожидания
+    def set_rate(self, rate, capacity):
+        with self.condition:
+            self._refill()
+            self.rate = rate
+            self.capacity = capacity
+            self.tokens = min(self.tokens, capacity)
+            self.condition.notify_all()
+
+    def stats(self):
+        with self.condition:
+            return {
+                "acquired": self.acquired,
+                "waited": self.waited,
+                "wait_time": self.wait_time,
+                "max_wait": self.max_wait,
+                "rejected": dict(self.rejected),
+                "queue": len(self.waiters),
+            }
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# Общий для процесса ограничитель по ключу: лимиты VK и OpenAI считаются на ключ доступа
+def get_rate_limiter(key, name, rate, capacity):
+    with rate_limiters_lock:
+        if key not in rate_limiters:
+            rate_limiters[key] = TokenBucket(name, rate, capacity)
+        return rate_limiters[key]
+
+# Сессии с shard-peers отвечают собеседникам из всех процессов-исполнителей с одним ключом VK,
+# поэтому лимит такого ключа делится между процессами: каждый получает 1/vk_rate_shares
+vk_rate_shares = 1
+shared_vk_limiters = {}  # ключ доступа -> (ограничитель, полный лимит)
+
+# Ограничитель VK API для ключа доступа: у сообществ лимит выше, чем у пользователей
+def get_vk_rate_limiter(vk_token, group_id=None, shared=False):
+    rate = VK_GROUP_RPS if group_id else VK_USER_RPS
+    name = f"vk-group-{group_id}" if group_id else "vk-user"
+    limiter = get_rate_limiter(("vk", vk_token), name, rate, rate)
+    if shared:
+        with rate_limiters_lock:
+            shared_vk_limiters[vk_token] = (limiter, rate)
+            share = rate / vk_rate_shares
+        limiter.set_rate(share, max(1, share))
+    return limiter
+
+# Число процессов, между которыми делится лимит ключей сессий с shard-peers; меняется вместе с составом процессов
+def set_vk_rate_shares(shares):
+    global vk_rate_shares
+    with rate_limiters_lock:
+        vk_rate_shares = max(1, shares)
+        limiters = list(shared_vk_limiters.values())
+    for limiter, rate in limiters:
+        share = rate / vk_rate_shares
+        limiter.set_rate(share, max(1, share))
+
+# Ограничители OpenAI: отдельно на запросы в минуту и на токены в минуту
+def get_openai_rate_limiters(openai_token):
+    return (
+        get_rate_limiter(("openai-rpm", openai_token), "openai-requests", OPENAI_RPM / 60, OPENAI_RPM / 6),
+        get_rate_limiter(("openai-tpm", openai_token), "openai-tokens", OPENAI_TPM / 60, OPENAI_TPM / 6),
+    )
+
+# Пакетная отправка запросов VK API: вызовы из разных потоков, сделанные в течение VK_BATCH_WINDOW
+# (или пока не наберётся VK_BATCH_SIZE), уходят одним запросом execute. Каждый вызывающий поток
+# получает свой результат или свою ошибку ApiError, как при обычном вызове. Запросы уходят через
+# общую HTTP-сессию напрямую, а не через VkApi.method: тот держит блокировку сессии на всё время
+# запроса, и до VK_BATCH_CONCURRENCY пакетов одного аккаунта не могли бы выполняться одновременно.
+class VkBatcher:
+    def __init__(self, vk_session, limiter=None, window=VK_BATCH_WINDOW, size=VK_BATCH_SIZE, concurrency=VK_BATCH_CONCURRENCY):
+        self.vk_session = vk_session
+        self.limiter = limiter if RATE_LIMIT_ENABLED else None
+        self.window = window
+        self.size = size
+        self.calls = []  # (method, params, future)
+        self.condition = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="vk-batch")
+        self.batches = 0
+        self.batched_calls = 0
+        self.closed = False
+        self.collector = threading.Thread(target=self._collector, name="vk-batch-collector", daemon=True)
+        self.collector.start()
+
+    # Остановка сборщика и пула: после неё вызовы идут в VK по одному, без пакетов
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.collector.join()
+        self.executor.shutdown(wait=False)
+
+    def get_api(self):
+        return BatchedVkApiMethod(self)
+
+    def call(self, method, params):
+        started = time.perf_counter()
         try:
-            return request_func()
-        except (ConnectionError, ReadTimeout, vk_api.exceptions.ApiError) as e:
-            retries += 1
-            if retries == max_retries:
-                raise Exception(f"Не удалось выполнить запрос после {max_retries} попыток: {e}")
-            wait_time = backoff_factor * (2 ** retries)
-            print(f"Ошибка VK API: {e}. Повторная попытка {retries}/{max_retries}. Ожидание {wait_time} секунд.")
-            time.sleep(wait_time)
+            result = self._call(method, params)
+        except Exception as e:
+            record_api_call("vk", method, started, e)
+            raise
+        record_api_call("vk", method, started)
+        return result
+
+    def _call(self, method, params):
+        # Параметры приводятся к виду, в котором их отправил бы vk_api
+        params = {k: (",".join(str(x) for x in v) if isinstance(v, (list, tuple)) else int(v) if isinstance(v, bool) else v)
+                  for k, v in params.items() if v is not None}
+        priority = VK_METHOD_PRIORITY.get(method, PRIORITY_READ)
+        if self.limiter and priority >= PRIORITY_COSMETIC and self.limiter.should_shed(priority):
+            raise RateLimitShed(f"{method} пропущен: лимит запросов {self.limiter.name} исчерпан")
+        future = None
+        if VK_BATCH_ENABLED and method != "execute":
+            with self.condition:
+                if not self.closed:
+                    future = Future()
+                    self.calls.append((priority, method, params, future))
+                    self.condition.notify()
+        if future is None:
+            if self.limiter:
+                self.limiter.acquire(priority=priority)
+            return self._post(method, params)
+        return future.result()
+
+    # Вызовы, поставленные в очередь до close(), ещё отправляются; затем сборщик завершается
+    def _collector(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.calls or self.closed)
+                if not self.calls:
+                    return
+                deadline = time.monotonic() + self.window
+                while len(self.calls) < self.size and not self.closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.condition.wait(remaining)
+                # Важные вызовы (отправка сообщений) уходят первыми, если в очереди больше одного пакета
+                self.calls.sort(key=lambda call: call[0])
+                batch = [call[1:] for call in self.calls[:self.size]]
+                priority = self.calls[0][0]
+                del self.calls[:self.size]
+            self.executor.submit(self._execute, batch, priority)
+
+    def _execute(self, batch, priority=PRIORITY_READ):
+        if self.limiter:
+            self.limiter.acquire(priority=priority)
+        if len(batch) == 1:
+            method, params, future = batch[0]
+            try:
+                future.set_result(self._post(method, params))
+            except Exception as e:
+                future.set_exception(e)
+            return
+        code = "return [" + ",".join(
+            f"API.{method}({json.dumps(params, ensure_ascii=False)})" for method, params, _ in batch) + "];"
+        try:
+            raw = self._post("execute", {"code": code}, raw=True)
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.batches += 1
+        self.batched_calls += len(batch)
+        results = raw.get("response") or [False] * len(batch)
+        errors = list(raw.get("execute_errors", []))
+        # Неудачные обращения возвращают false, а ошибки перечислены в execute_errors в том же порядке
+        for (method, params, future), result in zip(batch, results):
+            if result is False and errors:
+                error = errors.pop(0)
+                future.set_exception(vk_api.exceptions.ApiError(self.vk_session, method, params, raw, error))
+            else:
+                future.set_result(result)
+
+    # Один запрос к VK API. Ошибку 6 (слишком много запросов в секунду) vk_api повторял сам,
+    # здесь так же: до VK_RPS_RETRIES раз с паузой VK_RPS_RETRY_DELAY
+    def _post(self, method, params, raw=False):
+        values = dict(params, access_token=self.vk_session.token["access_token"], v=self.vk_session.api_version)
+        for attempt in range(VK_RPS_RETRIES + 1):
+            response = http_session.post(VK_API_URL + method, data=values).json()
+            error = response.get("error")
+            if not error:
+                return response if raw else response["response"]
+            if error.get("error_code") != 6 or attempt == VK_RPS_RETRIES:
+                raise vk_api.exceptions.ApiError(self.vk_session, method, values, response, error)
+            time.sleep(VK_RPS_RETRY_DELAY)
+
+    def stats(self):
+        return {"batches": self.batches, "batched_calls": self.batched_calls}
+
+# Аналог vk_api.VkApiMethod: vk.messages.send(...) ставит вызов в очередь VkBatcher
+class BatchedVkApiMethod:
+    def __init__(self, batcher, method=None):
+        self._batcher = batcher
+        self._method = method
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        if "_" in name:
+            parts = name.split("_")
+            name = parts[0] + "".join(part.title() for part in parts[1:])
+        return BatchedVkApiMethod(self._batcher, f"{self._method}.{name}" if self._method else name)
+
+    def __call__(self, **params):
+        return self._batcher.call(self._method, params)
 
 # Сканирование и выбор сессии
 def scan_sessions():
@@ -93,7 +762,7 @@ def create_new_session():
         return None
 
     if group_id:
-        vk_session = vk_api.VkApi(token=vk_token)
+        vk_session = vk_api.VkApi(token=vk_token, session=http_session)
         vk = vk_session.get_api()
         group_info = vk.groups.getById(group_id=group_id, fields="description")[0]
         group_name = clean_filename(group_info["name"])
@@ -132,7 +801,7 @@ def create_new_session():
 # Аутентификация пользователя или группы
 def authenticate_vk(vk_token, group_id=None):
     try:
-        vk_session = vk_api.VkApi(token=vk_token)
+        vk_session = vk_api.VkApi(token=vk_token, session=http_session)
         vk = vk_session.get_api()
         if group_id:
             group_info = vk.groups.getById(group_id=group_id)[0]
@@ -147,49 +816,208 @@ def authenticate_vk(vk_token, group_id=None):
         print(f"Ошибка аутентификации: {e}")
         return None
 
+# Кэш с ограниченным сроком жизни и вытеснением давно не использованных записей (LRU).
+# Устаревшую запись обновляет один поток, остальные ждут его результата вместо повторного запроса.
+class TTLCache:
+    def __init__(self, name, maxsize, ttl):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.items = OrderedDict()  # ключ -> (момент устаревания, значение)
+        self.loading = {}           # ключ -> threading.Event загрузки, которая уже идёт
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, loader):
+        while True:
+            with self.lock:
+                item = self.items.get(key)
+                if item and item[0] > time.monotonic():
+                    self.items.move_to_end(key)
+                    self.hits += 1
+                    return item[1]
+                event = self.loading.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self.loading[key] = threading.Event()
+                    break
+            event.wait()
+        try:
+            value = loader()
+            with self.lock:
+                self.items[key] = (time.monotonic() + self.ttl, value)
+                self.items.move_to_end(key)
+                while len(self.items) > self.maxsize:
+                    self.items.popitem(last=False)
+                    self.evictions += 1
+            return value
+        finally:
+            with self.lock:
+                del self.loading[key]
+            event.set()
+
+    def invalidate(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            requests_total = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests_total if requests_total else 0.0,
+            }
+
+profile_cache = TTLCache("profiles", PROFILE_CACHE_SIZE, PROFILE_CACHE_TTL)
+chat_cache = TTLCache("chats", CHAT_CACHE_SIZE, CHAT_CACHE_TTL)
+
+# Вопрос для кэша ответов: регистр, «ё», пунктуация и лишние пробелы на совпадение не влияют
+def normalize_question(text):
+    return " ".join(re.findall(r"\w+", text.lower().replace("ё", "е")))
+
+# Кэш ответов на типовые вопросы. Ключ — хеш контекста сессии (коммерческая информация и правила)
+# и нормализованный вопрос. Похожие вопросы находятся по n-граммам символов через обратный индекс,
+# сходство — коэффициент Жаккара. Устаревшие записи удаляются по TTL, лишние — по давности использования.
+class ReplyCache:
+    def __init__(self, maxsize=REPLY_CACHE_SIZE, ttl=REPLY_CACHE_TTL, ngram=REPLY_CACHE_NGRAM):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.ngram = ngram
+        self.items = OrderedDict()  # (контекст, вопрос) -> {"expires", "reply", "tokens", "grams"}
+        self.index = {}             # (контекст, n-грамма) -> ключи записей с этой n-граммой
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.tokens_saved = 0
+
+    def _grams(self, question):
+        padded = f" {question} "
+        return frozenset(padded[i:i + self.ngram] for i in range(max(len(padded) - self.ngram + 1, 1)))
+
+    def _remove(self, key):
+        entry = self.items.pop(key)
+        for gram in entry["grams"]:
+            keys = self.index.get((key[0], gram))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.index[(key[0], gram)]
+
+    def _find(self, context, question, threshold):
+        key = (context, question)
+        if key in self.items:
+            return key, 1.0
+        grams = self._grams(question)
+        overlaps = {}
+        for gram in grams:
+            for candidate in self.index.get((context, gram), ()):
+                overlaps[candidate] = overlaps.get(candidate, 0) + 1
+        best, best_similarity = None, 0
+        for candidate, overlap in overlaps.items():
+            similarity = overlap / (len(grams) + len(self.items[candidate]["grams"]) - overlap)
+            if similarity > best_similarity:
+                best, best_similarity = candidate, similarity
+        if best is None or best_similarity < threshold:
+            return None, best_similarity
+        return best, best_similarity
+
+    # Ответ на вопрос, достаточно похожий на уже заданный: (ответ, токены исходного ответа, сходство) или None
+    def lookup(self, context, question, threshold):
+        with self.lock:
+            key, similarity = self._find(context, question, threshold)
+            if key is not None and self.items[key]["expires"] <= time.monotonic():
+                self._remove(key)
+                key = None
+            if key is None:
+                self.misses += 1
+                return None
+            entry = self.items[key]
+            self.items.move_to_end(key)
+            self.hits += 1
+            self.tokens_saved += entry["tokens"]["total"]
+            return entry["reply"], entry["tokens"], similarity
+
+    def store(self, context, question, reply, tokens):
+        key = (context, question)
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+            grams = self._grams(question)
+            self.items[key] = {"expires": time.monotonic() + self.ttl, "reply": reply, "tokens": tokens, "grams": grams}
+            for gram in grams:
+                self.index.setdefault((context, gram), set()).add(key)
+            while len(self.items) > self.maxsize:
+                self._remove(next(iter(self.items)))
+
+    def stats(self):
+        with self.lock:
+            requests_count = self.hits + self.misses
+            return {
+                "size": len(self.items),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests_count if requests_count else 0,
+                "tokens_saved": self.tokens_saved,
+            }
+
+reply_cache = ReplyCache()
+
+# Профиль пользователя с полным набором полей. Часть полей (blacklisted_by_me, friend_status и др.)
+# зависит от того, кто спрашивает, поэтому ключ кэша включает аккаунт-наблюдателя.
+def get_user_profile(vk, viewer_id, user_id):
+    return profile_cache.get((str(viewer_id), int(user_id)), lambda: network_retry.call(
+        lambda: vk.users.get(user_ids=user_id, fields=PROFILE_FIELDS)[0]))
+
+# Список ID участников беседы
+def get_chat_members(vk, viewer_id, chat_id):
+    return chat_cache.get((str(viewer_id), int(chat_id)), lambda: [
+        m["member_id"] for m in vk.messages.getChat(chat_id=chat_id, fields="members").get("members", [])])
+
+# Периодический вывод статистики кэшей и ограничителей частоты
+def stats_reporter():
+    while True:
+        time.sleep(STATS_INTERVAL)
+        for cache in (profile_cache, chat_cache):
+            stats = cache.stats()
+            print(f"Кэш {cache.name}: записей {stats['size']}, попаданий {stats['hits']}, промахов {stats['misses']}, "
+                  f"вытеснено {stats['evictions']}, доля попаданий {stats['hit_rate']:.0%}")
+        stats = history_cache.stats()
+        print(f"Кэш истории: диалогов {stats['peers']}, попаданий {stats['hits']}, промахов {stats['misses']}")
+        stats = reply_cache.stats()
+        if stats["hits"] or stats["misses"]:
+            print(f"Кэш ответов: записей {stats['size']}, попаданий {stats['hits']}, промахов {stats['misses']}, "
+                  f"доля попаданий {stats['hit_rate']:.0%}, сэкономлено токенов {stats['tokens_saved']}")
+        for line in metrics.summary():
+            print(line)
+        with rate_limiters_lock:
+            limiters = list(rate_limiters.values())
+        for limiter in limiters:
+            stats = limiter.stats()
+            average_wait = stats["wait_time"] / stats["waited"] if stats["waited"] else 0
+            print(f"Лимит {limiter.name}: выдано {stats['acquired']}, ожиданий {stats['waited']} "
+                  f"(в среднем {average_wait:.2f} с, максимум {stats['max_wait']:.2f} с), "
+                  f"отброшено {sum(stats['rejected'].values())}, в очереди {stats['queue']}")
+        stats = transport_stats()
+        for host in stats["hosts"]:
+            reuse = 1 - host["connections"] / host["requests"] if host["requests"] else 0
+            print(f"HTTP {host['host']}: запросов {host['requests']}, новых соединений {host['connections']}, "
+                  f"переиспользовано {reuse:.0%}")
+        print(f"OpenAI: открытых соединений {stats['openai_connections']}")
+
 # Получение информации о собеседнике и обновление досье
-def get_conversation_partner_info(vk, user_id):
-    fields = (
-        "activities, about, blacklisted, blacklisted_by_me, books, bdate, can_write_private_message, "
-        "career, city, contacts, education, followers_count, friend_status, home_town, interests, last_seen, movies, music, status"
-    )
-    partner_info = retry_request(lambda timeout: vk.users.get(user_ids=user_id, fields=fields)[0])
+def get_conversation_partner_info(vk, user_id, viewer_id):
+    partner_info = get_user_profile(vk, viewer_id, user_id)
     if partner_info and (partner_info.get("blacklisted") == 1 or partner_info.get("blacklisted_by_me") == 1 or partner_info.get("can_write_private_message") == 0):
         print("Собеседник заблокирован или не может писать в личные сообщения.")
         return None
 
     filtered_info = {k: (v[:1000] if isinstance(v, str) and len(v) > 1000 else v) for k, v in partner_info.items() if v and k not in ["blacklisted", "blacklisted_by_me", "can_write_private_message"]}
-    dossier_file = os.path.join(DOSSIER_DIR, f"{partner_info['first_name']}_{partner_info['last_name']}_{user_id}.json")
-
-    default_dossier = {
-        "tokens_in": 0,
-        "tokens_out": 0,
-        "tokens_total": 0,
-        "tokens_cost": 0,
-        "photo_description": "",
-        "characteristic": "",
-        "sale_status": "",
-        "profit": 0,
-        "api_token": "",
-        "token_added": "",
-        "token_status": "",
-        "contacts": ""
-    }
-
-    if os.path.exists(dossier_file):
-        with open(dossier_file, "r", encoding="utf-8") as file:
-            old_data = json.load(file)
-        for key, value in filtered_info.items():
-            old_data[key] = value
-        for key, value in default_dossier.items():
-            if key not in old_data:
-                old_data[key] = value
-        dossier_data = old_data
-    else:
-        dossier_data = {**filtered_info, **default_dossier}
-
-    with open(dossier_file, "w", encoding="utf-8") as file:
-        json.dump(dossier_data, file, ensure_ascii=False)
+    get_storage().update_dossier(user_id, filtered_info)
     return json.dumps(filtered_info, ensure_ascii=False)
 
 # Функция для экранирования только кавычек и слэшей
@@ -197,297 +1025,1827 @@ def escape_json_string(text):
     return text.replace('"', '\\"').replace('\\', '\\\\')
 
 # Функция для декодирования Unicode-последовательностей
+# Символы вне latin-1 сначала превращаются в \uXXXX, иначе unicode_escape портит кириллицу
 def decode_unicode(text):
-    return unicodedata.normalize('NFKD', text.encode().decode('unicode_escape'))
-
-# Формирование запроса OpenAI
-def create_openai_prompt(config, conversation_history, partner_info, entity_id):
-    date_time_str = datetime.now().strftime("%A %d %B %Y, %H:%M:%S")
-    personality = decode_unicode(config['DEFAULT']['personality'])
-    commercial_info = decode_unicode(config['DEFAULT']['commercial-info'])
-    conversation_rules = decode_unicode(config['DEFAULT']['conversation-rules'])
-    conversation_goal = decode_unicode(config['DEFAULT']['conversation-goal'])
-    
-    system_content = (
-        f"{date_time_str}\n"
-        "Ты переписываешься в личных сообщениях Вконтакте от Моего лица используя указанные данные и инструкции.\n"
-        f"Моя Личность: \"{personality}\"\n"
-        f"Коммерческая информация: \"{commercial_info}\"\n"
-        f"Мой Собеседник: \"{partner_info}\" . Информация предоставлена из API метода user.get ВКонтакте . "
-        "Пожалуйста расшифровывай пары \"ключ\": \"значение\" в соответствии с известной тебе документацией.\n"
-        f"Инструкции общения: \"{conversation_rules}\" , Цели общения: \"{conversation_goal}\" "
-    )
-    prompt = [{"role": "system", "content": system_content}]
+    return unicodedata.normalize('NFKD', text.encode('latin-1', 'backslashreplace').decode('unicode_escape'))
 
-    conversation_history = sorted(conversation_history, key=lambda msg: msg['date'])
-    for msg in conversation_history:
-        if not msg['text']:
-            continue
-        role = "assistant" if msg['from_id'] == int(entity_id) else "user"
-        content = escape_json_string(decode_unicode(msg['text']))[:1000]
-        prompt.append({"role": role, "content": content})
+# Отладочный вывод, включается константой DEBUG
+def debug(*args):
+    if DEBUG:
+        print(*args)
+
+token_encoding = None
+
+# Подсчёт токенов: точно через tiktoken, если он установлен, иначе оценка по длине текста
+def count_tokens(text):
+    global token_encoding
+    if token_encoding is None:
+        try:
+            import tiktoken
+            try:
+                token_encoding = tiktoken.encoding_for_model(OPENAI_MODEL)
+            except KeyError:
+                token_encoding = tiktoken.get_encoding("o200k_base")
+        except ImportError:
+            token_encoding = False
+    if token_encoding:
+        return len(token_encoding.encode(text))
+    return len(text) // 3 + 1
+
+# Токены сообщения промпта с учётом служебной разметки роли
+def count_message_tokens(message):
+    return count_tokens(message["content"]) + 4
+
+# Формирование запроса OpenAI. Постоянная часть системного сообщения собирается один раз на сессию,
+# история добавляется от новых сообщений к старым, пока укладывается в PROMPT_TOKEN_BUDGET.
+class PromptBuilder:
+    def __init__(self, config, entity_id):
+        self.entity_id = int(entity_id)
+        personality = decode_unicode(config['DEFAULT']['personality'])
+        commercial_info = decode_unicode(config['DEFAULT']['commercial-info'])
+        conversation_rules = decode_unicode(config['DEFAULT']['conversation-rules'])
+        conversation_goal = decode_unicode(config['DEFAULT']['conversation-goal'])
+
+        self.head = (
+            "Ты переписываешься в личных сообщениях Вконтакте от Моего лица используя указанные данные и инструкции.\n"
+            f"Моя Личность: \"{personality}\"\n"
+            f"Коммерческая информация: \"{commercial_info}\"\n"
+        )
+        self.partner_note = (
+            " . Информация предоставлена из API метода user.get ВКонтакте . "
+            "Пожалуйста расшифровывай пары \"ключ\": \"значение\" в соответствии с известной тебе документацией.\n"
+        )
+        self.tail = f"Инструкции общения: \"{conversation_rules}\" , Цели общения: \"{conversation_goal}\" "
+        self.final_message = {"role": "system", "content": "Предоставь ответ для диалога. В ответ только готовое к отправке сообщение и ничего больше."}
+        # Постоянная часть промпта плюс запас на дату и служебную разметку
+        self.static_tokens = count_tokens(self.head + "Мой Собеседник: \"\"" + self.partner_note + self.tail) + count_message_tokens(self.final_message) + 20
+
+    # Сообщение истории в виде для промпта; результат запоминается в самом сообщении кэша истории
+    def _history_message(self, msg):
+        cached = msg.get("_prompt")
+        if cached is None or cached[0] != self.entity_id:
+            role = "assistant" if msg['from_id'] == self.entity_id else "user"
+            content = escape_json_string(decode_unicode(msg['text']))[:PROMPT_MESSAGE_MAX_CHARS]
+            message = {"role": role, "content": content}
+            cached = msg["_prompt"] = (self.entity_id, message, count_message_tokens(message))
+        return cached[1], cached[2]
 
-    prompt.append({"role": "system", "content": "Предоставь ответ для диалога. В ответ только готовое к отправке сообщение и ничего больше."})
-    print("Цепочка сообщений для OpenAI:", prompt)
-    return prompt
+    # Возвращает промпт и список старых сообщений, не поместившихся в бюджет
+    def build(self, conversation_history, partner_info, summary=""):
+        date_time_str = datetime.now().strftime("%A %d %B %Y, %H:%M:%S")
+        system_content = (
+            f"{date_time_str}\n"
+            f"{self.head}"
+            f"Мой Собеседник: \"{partner_info}\"{self.partner_note}"
+            f"{self.tail}"
+        )
+        if summary:
+            system_content += f"\nКраткое содержание более ранней переписки: \"{summary}\""
+        budget = PROMPT_TOKEN_BUDGET - self.static_tokens - count_tokens(partner_info) - count_tokens(summary)
+        if PROMPT_SUMMARY_ENABLED and not summary:
+            budget -= PROMPT_SUMMARY_MAX_TOKENS
+
+        conversation_history = sorted((msg for msg in conversation_history if msg['text']), key=lambda msg: msg['date'])
+        history = []
+        cut = 0
+        for idx in range(len(conversation_history) - 1, -1, -1):
+            message, tokens = self._history_message(conversation_history[idx])
+            if tokens > budget and history:
+                cut = idx + 1
+                break
+            budget -= tokens
+            history.append(message)
+        history.reverse()
+
+        prompt = [{"role": "system", "content": system_content}, *history, self.final_message]
+        debug("Цепочка сообщений для OpenAI:", prompt)
+        return prompt, conversation_history[:cut]
+
+summaries_in_progress = set()
+summaries_lock = threading.Lock()
+
+# Краткое содержание ранней переписки хранится в досье. Если в бюджет не поместились сообщения, которых
+# в нём ещё нет, оно обновляется в фоне и будет использовано в следующих ответах.
+def schedule_history_summary(ctx, user_id, dropped):
+    dossier = get_storage().get_dossier(user_id) or {}
+    new_messages = [msg for msg in dropped if msg["date"] > dossier.get("history_summary_upto", 0)]
+    if not new_messages:
+        return
+    with summaries_lock:
+        if user_id in summaries_in_progress:
+            return
+        summaries_in_progress.add(user_id)
+    threading.Thread(target=refresh_history_summary, args=(ctx, user_id, dossier.get("history_summary", ""), new_messages), daemon=True).start()
+
+def refresh_history_summary(ctx, user_id, summary, new_messages):
+    try:
+        lines = "\n".join(
+            f"{'Я' if msg['from_id'] == int(ctx.entity_id) else 'Собеседник'}: {msg['text'][:PROMPT_MESSAGE_MAX_CHARS]}" for msg in new_messages)
+        prompt = [
+            {"role": "system", "content": "Ты ведёшь краткое содержание переписки. Обнови его с учётом новых сообщений: "
+                                          "сохрани факты о собеседнике, договорённости и важные темы. В ответ только краткое содержание."},
+            {"role": "user", "content": f"Текущее краткое содержание: \"{summary}\"\nНовые сообщения:\n{lines}"},
+        ]
+        response = create_completion(ctx, prompt, max_tokens=PROMPT_SUMMARY_MAX_TOKENS)
+        tokens_data = tokens_from_usage(response.usage)
+        get_storage().update_dossier(user_id, {
+            "history_summary": response.choices[0].message.content,
+            "history_summary_upto": new_messages[-1]["date"],
+        })
+        update_session_tokens(ctx.session_file, tokens_data)
+        update_dossier_tokens(user_id, tokens_data)
+        debug(f"Краткое содержание переписки с {user_id} обновлено.")
+    except Exception as e:
+        print(f"Ошибка обновления краткого содержания переписки с {user_id}: {e}")
+    finally:
+        with summaries_lock:
+            summaries_in_progress.discard(user_id)
+
+# Жив ли процесс с этим PID. В Windows os.kill(pid, 0) завершил бы процесс, поэтому там — через OpenProcess
+def process_alive(pid):
+    if os.name == "nt":
+        import ctypes
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(0x1000, False, pid)  # PROCESS_QUERY_LIMITED_INFORMATION
+        if not handle:
+            return False
+        exit_code = ctypes.c_ulong()
+        kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+        kernel32.CloseHandle(handle)
+        return exit_code.value == 259  # STILL_ACTIVE
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+# Хранилище досье и счётчиков токенов в SQLite (WAL). Запись идёт через одно соединение под замком,
+# изменения копятся в открытой транзакции и фиксируются пачкой по таймеру или по числу изменений.
+class Storage:
+    # batched=False — режим нескольких процессов: каждая запись (или группа записей в transaction())
+    # фиксируется сразу, чтобы не держать блокировку записи базы до следующего сброса и не задерживать
+    # захват сообщений и учёт токенов в других процессах
+    def __init__(self, path=STORAGE_DB, batched=True):
+        self.path = path
+        self.batched = batched
+        self.depth = 0
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS dossiers (
+                user_id INTEGER PRIMARY KEY,
+                data TEXT NOT NULL,
+                tokens_in INTEGER NOT NULL DEFAULT 0,
+                tokens_out INTEGER NOT NULL DEFAULT 0,
+                tokens_total INTEGER NOT NULL DEFAULT 0,
+                tokens_cost REAL NOT NULL DEFAULT 0,
+                updated_at TEXT
+            );
+            CREATE TABLE IF NOT EXISTS session_tokens (
+                session TEXT PRIMARY KEY,
+                tokens_in INTEGER NOT NULL DEFAULT 0,
+                tokens_out INTEGER NOT NULL DEFAULT 0,
+                tokens_total INTEGER NOT NULL DEFAULT 0,
+                tokens_cost REAL NOT NULL DEFAULT 0,
+                cache_hits INTEGER NOT NULL DEFAULT 0,
+                cache_misses INTEGER NOT NULL DEFAULT 0,
+                tokens_saved INTEGER NOT NULL DEFAULT 0,
+                cost_saved REAL NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS history (
+                account TEXT NOT NULL,
+                peer_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                from_id INTEGER NOT NULL,
+                date INTEGER NOT NULL,
+                text TEXT NOT NULL,
+                PRIMARY KEY (account, peer_id, message_id)
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS longpoll_cursors (
+                account TEXT PRIMARY KEY,
+                ts TEXT,
+                pts INTEGER,
+                updated_at INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS processed_messages (
+                account TEXT NOT NULL,
+                message_id INTEGER NOT NULL,
+                claimed_at INTEGER NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0,
+                owner TEXT NOT NULL DEFAULT '',
+                PRIMARY KEY (account, message_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS processed_messages_claimed_at ON processed_messages (claimed_at);
+        """)
+        # Базы, созданные до появления кэша ответов, получают недостающие столбцы статистики
+        columns = {row["name"] for row in self.conn.execute("PRAGMA table_info(session_tokens)")}
+        for column, kind in (("cache_hits", "INTEGER"), ("cache_misses", "INTEGER"), ("tokens_saved", "INTEGER"), ("cost_saved", "REAL")):
+            if column not in columns:
+                try:
+                    self.conn.execute(f"ALTER TABLE session_tokens ADD COLUMN {column} {kind} NOT NULL DEFAULT 0")
+                except sqlite3.OperationalError:
+                    pass  # столбец только что добавил другой процесс
+        if "owner" not in {row["name"] for row in self.conn.execute("PRAGMA table_info(processed_messages)")}:
+            try:
+                self.conn.execute("ALTER TABLE processed_messages ADD COLUMN owner TEXT NOT NULL DEFAULT ''")
+            except sqlite3.OperationalError:
+                pass
+        # Владелец захватов сообщений — этот процесс: PID и метка запуска, чтобы не спутать его
+        # с другим процессом, получившим тот же PID. Метка записывается в meta под PID процесса.
+        self.owner = f"{os.getpid()}:{os.urandom(4).hex()}"
+        self.conn.execute("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                          (f"claim-owner:{os.getpid()}", self.owner))
+        self.conn.commit()
+        self.pending_writes = 0
+        self.pruned_at = 0
+        threading.Thread(target=self._flusher, daemon=True).start()
+        atexit.register(self.commit)
+
+    def commit(self):
+        with self.lock:
+            if self.pending_writes:
+                self.conn.commit()
+                self.pending_writes = 0
+
+    def _write(self, sql, params=()):
+        with self.lock:
+            cursor = self.conn.execute(sql, params)
+            self.pending_writes += 1
+            if self.pending_writes >= STORAGE_COMMIT_EVERY or (not self.batched and not self.depth):
+                self.commit()
+            return cursor
+
+    # Несколько записей одной транзакцией; без пакетной фиксации она закрывается сразу после группы
+    @contextmanager
+    def transaction(self):
+        with self.lock:
+            self.depth += 1
+            try:
+                yield
+            finally:
+                self.depth -= 1
+                if not self.batched and not self.depth:
+                    self.commit()
+
+    def _flusher(self):
+        while True:
+            time.sleep(STORAGE_COMMIT_INTERVAL)
+            try:
+                if time.time() - self.pruned_at >= 3600:
+                    self.prune_processed()
+                self.commit()
+            except sqlite3.Error as e:
+                print(f"Ошибка записи в базу {self.path}: {e}")
+
+    def get_dossier(self, user_id):
+        with self.lock:
+            row = self.conn.execute("SELECT * FROM dossiers WHERE user_id = ?", (int(user_id),)).fetchone()
+        if not row:
+            return None
+        dossier = json.loads(row["data"])
+        for field in ("tokens_in", "tokens_out", "tokens_total", "tokens_cost"):
+            dossier[field] = row[field]
+        return dossier
+
+    # Обновление данных профиля в досье: новые значения поверх старых, недостающие поля — по умолчанию
+    def update_dossier(self, user_id, profile):
+        now = datetime.now().isoformat(timespec="seconds")
+        with self.transaction():
+            row = self.conn.execute("SELECT data FROM dossiers WHERE user_id = ?", (int(user_id),)).fetchone()
+            data = {**DEFAULT_DOSSIER, **(json.loads(row["data"]) if row else {}), **profile}
+            self._write(
+                "INSERT INTO dossiers (user_id, data, updated_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at",
+                (int(user_id), json.dumps(data, ensure_ascii=False), now))
+
+    def add_dossier_tokens(self, user_id, tokens):
+        self._write(
+            "INSERT INTO dossiers (user_id, data, tokens_in, tokens_out, tokens_total, tokens_cost) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET tokens_in = tokens_in + excluded.tokens_in, tokens_out = tokens_out + excluded.tokens_out, "
+            "tokens_total = tokens_total + excluded.tokens_total, tokens_cost = tokens_cost + excluded.tokens_cost",
+            (int(user_id), json.dumps(DEFAULT_DOSSIER), tokens["input"], tokens["output"], tokens["total"], tokens["cost"]))
+
+    def add_session_tokens(self, session, tokens):
+        self._write(
+            "INSERT INTO session_tokens (session, tokens_in, tokens_out, tokens_total, tokens_cost) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(session) DO UPDATE SET tokens_in = tokens_in + excluded.tokens_in, tokens_out = tokens_out + excluded.tokens_out, "
+            "tokens_total = tokens_total + excluded.tokens_total, tokens_cost = tokens_cost + excluded.tokens_cost",
+            (session, tokens["input"], tokens["output"], tokens["total"], tokens["cost"]))
+
+    # Обращение к кэшу ответов: при попадании учитываются токены и стоимость, которые не пришлось тратить
+    def add_reply_cache_stats(self, session, hit, tokens=None):
+        saved = tokens if hit and tokens else {"total": 0, "cost": 0}
+        self._write(
+            "INSERT INTO session_tokens (session, cache_hits, cache_misses, tokens_saved, cost_saved) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(session) DO UPDATE SET cache_hits = cache_hits + excluded.cache_hits, "
+            "cache_misses = cache_misses + excluded.cache_misses, tokens_saved = tokens_saved + excluded.tokens_saved, "
+            "cost_saved = cost_saved + excluded.cost_saved",
+            (session, int(hit), int(not hit), saved["total"], saved["cost"]))
+
+    # Сохранение сообщений диалога; в базе остаются только последние HISTORY_LIMIT
+    def save_history(self, account, peer_id, messages):
+        with self.transaction():
+            for msg in messages:
+                if msg["id"] is None:
+                    continue
+                self._write(
+                    "INSERT OR REPLACE INTO history (account, peer_id, message_id, from_id, date, text) VALUES (?, ?, ?, ?, ?, ?)",
+                    (str(account), int(peer_id), int(msg["id"]), int(msg["from_id"]), int(msg["date"]), msg["text"]))
+            self._write(
+                "DELETE FROM history WHERE account = ? AND peer_id = ? AND message_id NOT IN "
+                "(SELECT message_id FROM history WHERE account = ? AND peer_id = ? ORDER BY date DESC, message_id DESC LIMIT ?)",
+                (str(account), int(peer_id), str(account), int(peer_id), HISTORY_LIMIT))
+
+    def load_history(self, account, peer_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT message_id, from_id, date, text FROM history WHERE account = ? AND peer_id = ? ORDER BY date, message_id",
+                (str(account), int(peer_id))).fetchall()
+        return [{"id": row["message_id"], "from_id": row["from_id"], "date": row["date"], "text": row["text"]} for row in rows]
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key, value):
+        self._write("INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value", (key, value))
+
+    # Курсор LongPoll аккаунта: ts для продолжения опроса, pts для догрузки пропущенного через getLongPollHistory
+    def get_cursor(self, account):
+        with self.lock:
+            row = self.conn.execute("SELECT ts, pts FROM longpoll_cursors WHERE account = ?", (str(account),)).fetchone()
+        return {"ts": row["ts"], "pts": row["pts"]} if row else None
+
+    # Пустой pts оставляет сохранённый: ts обновляется с каждой пачкой событий, pts — с отставанием
+    def save_cursor(self, account, ts, pts=None):
+        self._write(
+            "INSERT INTO longpoll_cursors (account, ts, pts, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(account) DO UPDATE SET ts = excluded.ts, pts = COALESCE(excluded.pts, pts), updated_at = excluded.updated_at",
+            (str(account), str(ts), pts, int(time.time())))
+
+    # Захват сообщения на обработку. Фиксируется сразу, чтобы ни повторный запуск, ни другой процесс его не взяли;
+    # захват, не завершённый за MESSAGE_CLAIM_TIMEOUT (ответ не удался), можно взять снова. Захваты
+    # упавшего процесса снимаются раньше — release_claims при запуске аккаунта и перезапуске процесса.
+    def claim_message(self, account, message_id):
+        now = int(time.time())
+        with self.lock:
+            self.commit()
+            cursor = self.conn.execute(
+                "INSERT INTO processed_messages (account, message_id, claimed_at, owner) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(account, message_id) DO UPDATE SET claimed_at = excluded.claimed_at, owner = excluded.owner "
+                "WHERE done = 0 AND claimed_at < ?",
+                (str(account), int(message_id), now, self.owner, now - MESSAGE_CLAIM_TIMEOUT))
+            self.conn.commit()
+        return cursor.rowcount > 0
+
+    def is_processed(self, account, message_id):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT done, claimed_at FROM processed_messages WHERE account = ? AND message_id = ?",
+                (str(account), int(message_id))).fetchone()
+        return bool(row) and (row["done"] or row["claimed_at"] >= time.time() - MESSAGE_CLAIM_TIMEOUT)
+
+    # Владелец захвата ещё работает: процесс с его PID жив и это тот же запуск, а не новый процесс с тем же PID
+    def owner_alive(self, owner):
+        pid, _, _ = owner.partition(":")
+        if owner == self.owner:
+            return True
+        return pid.isdigit() and process_alive(int(pid)) and self.get_meta(f"claim-owner:{pid}") == owner
+
+    # Снятие незавершённых захватов процессов, которых больше нет: сообщения аккаунта account или
+    # (для супервизора) захваченные завершившимся процессом pid. Возвращает число снятых захватов.
+    def release_claims(self, account=None, pid=None):
+        with self.lock:
+            if pid is not None:
+                cursor = self._write("DELETE FROM processed_messages WHERE done = 0 AND owner LIKE ?", (f"{int(pid)}:%",))
+                return cursor.rowcount
+            owners = [row["owner"] for row in self.conn.execute(
+                "SELECT DISTINCT owner FROM processed_messages WHERE account = ? AND done = 0", (str(account),))]
+            released = 0
+            with self.transaction():
+                for owner in owners:
+                    if not self.owner_alive(owner):
+                        released += self._write("DELETE FROM processed_messages WHERE account = ? AND owner = ? AND done = 0",
+                                                (str(account), owner)).rowcount
+            return released
+
+    def finish_messages(self, account, message_ids):
+        with self.transaction():
+            for message_id in message_ids:
+                self._write("UPDATE processed_messages SET done = 1 WHERE account = ? AND message_id = ?",
+                            (str(account), int(message_id)))
+
+    def prune_processed(self):
+        self.pruned_at = time.time()
+        self._write("DELETE FROM processed_messages WHERE claimed_at < ?", (int(time.time()) - PROCESSED_RETENTION,))
+
+storage = None
+storage_pid = None
+storage_batched = True  # False в процессах под супервизором: база общая, транзакции должны быть короткими
+storage_init_lock = threading.Lock()
+
+# Общее хранилище процесса; после fork открывается заново, соединения SQLite между процессами не переносятся
+def get_storage():
+    global storage, storage_pid
+    with storage_init_lock:
+        if storage is None or storage_pid != os.getpid():
+            storage = Storage(batched=storage_batched)
+            storage_pid = os.getpid()
+    return storage
+
+# Разовый перенос досье из Dossier/*.json и счётчиков токенов из Sessions/*.ini в базу
+def migrate_legacy_files(db):
+    if db.get_meta("legacy_migrated"):
+        return
+    dossiers = 0
+    for dossier_file in glob.glob(os.path.join(DOSSIER_DIR, "*.json")):
+        try:
+            with open(dossier_file, "r", encoding="utf-8") as file:
+                data = json.load(file)
+            user_id = data.get("id") or os.path.splitext(os.path.basename(dossier_file))[0].rsplit("_", 1)[-1]
+            tokens = {
+                "input": int(data.pop("tokens_in", 0) or 0),
+                "output": int(data.pop("tokens_out", 0) or 0),
+                "total": int(data.pop("tokens_total", 0) or 0),
+                "cost": float(data.pop("tokens_cost", 0) or 0),
+            }
+            db.update_dossier(int(user_id), data)
+            db.add_dossier_tokens(int(user_id), tokens)
+            dossiers += 1
+        except (ValueError, OSError) as e:
+            print(f"Не удалось перенести досье {dossier_file}: {e}")
+    sessions = 0
+    for session_file in glob.glob(os.path.join(SESSIONS_DIR, "*.ini")):
+        config = configparser.ConfigParser()
+        config.read(session_file, encoding="utf-8")
+        try:
+            tokens = {
+                "input": int(config["DEFAULT"].get("tokens_in", 0)),
+                "output": int(config["DEFAULT"].get("tokens_out", 0)),
+                "total": int(config["DEFAULT"].get("tokens_total", 0)),
+                "cost": float(config["DEFAULT"].get("tokens_cost", 0)),
+            }
+        except ValueError as e:
+            print(f"Не удалось перенести счётчики сессии {session_file}: {e}")
+            continue
+        db.add_session_tokens(os.path.basename(session_file), tokens)
+        sessions += 1
+    db.set_meta("legacy_migrated", datetime.now().isoformat(timespec="seconds"))
+    db.commit()
+    print(f"Перенесено в базу {db.path}: досье — {dossiers}, сессий — {sessions}.")
 
 # Обновление токенов в сессии
 def update_session_tokens(session_file, tokens):
-    config = configparser.ConfigParser()
-    config.read(session_file, encoding="utf-8")
-    current_in = int(config["DEFAULT"].get("tokens_in", 0))
-    current_out = int(config["DEFAULT"].get("tokens_out", 0))
-    current_total = int(config["DEFAULT"].get("tokens_total", 0))
-    current_cost = float(config["DEFAULT"].get("tokens_cost", 0))
+    get_storage().add_session_tokens(os.path.basename(session_file), tokens)
 
-    config["DEFAULT"]["tokens_in"] = str(current_in + tokens["input"])
-    config["DEFAULT"]["tokens_out"] = str(current_out + tokens["output"])
-    config["DEFAULT"]["tokens_total"] = str(current_total + tokens["total"])
-    config["DEFAULT"]["tokens_cost"] = str(current_cost + tokens["cost"])
+# Обновление токенов в досье
+def update_dossier_tokens(user_id, tokens):
+    get_storage().add_dossier_tokens(user_id, tokens)
 
-    with open(session_file, "w", encoding="utf-8") as configfile:
-        config.write(configfile)
+def update_reply_cache_stats(session_file, hit, tokens=None):
+    get_storage().add_reply_cache_stats(os.path.basename(session_file), hit, tokens)
 
-# Обновление токенов в досье
-def update_dossier_tokens(dossier_file, tokens):
-    with open(dossier_file, "r", encoding="utf-8") as file:
-        dossier_data = json.load(file)
+# Журнал отчётов: строки дописываются в CSV, reports.xlsx строится из журнала отдельно
+reports_lock = threading.Lock()
+
+# Ротация журнала: текущий файл переименовывается в reports-ГГГГММДД-ЧЧММСС.csv
+def rotate_report_journal():
+    if not os.path.exists(REPORTS_JOURNAL):
+        return
+    stat = os.stat(REPORTS_JOURNAL)
+    too_big = stat.st_size >= REPORTS_JOURNAL_MAX_BYTES
+    new_day = REPORTS_ROTATE_DAILY and datetime.fromtimestamp(stat.st_mtime).date() != datetime.now().date()
+    if not (too_big or new_day):
+        return
+    base, ext = os.path.splitext(REPORTS_JOURNAL)
+    rotated = f"{base}-{datetime.fromtimestamp(stat.st_mtime).strftime('%Y%m%d-%H%M%S')}{ext}"
+    suffix = 1
+    while os.path.exists(rotated):
+        rotated = f"{base}-{datetime.fromtimestamp(stat.st_mtime).strftime('%Y%m%d-%H%M%S')}-{suffix}{ext}"
+        suffix += 1
+    os.replace(REPORTS_JOURNAL, rotated)
+    print(f"Журнал отчётов перенесён в {rotated}.")
+
+# Все файлы журнала в хронологическом порядке: сначала ротированные, текущий последним
+def report_journal_files():
+    base, ext = os.path.splitext(REPORTS_JOURNAL)
+    files = sorted(glob.glob(f"{glob.escape(base)}-*{ext}"), key=lambda f: (os.path.getmtime(f), f))
+    if os.path.exists(REPORTS_JOURNAL):
+        files.append(REPORTS_JOURNAL)
+    return files
 
-    dossier_data["tokens_in"] = dossier_data.get("tokens_in", 0) + tokens["input"]
-    dossier_data["tokens_out"] = dossier_data.get("tokens_out", 0) + tokens["output"]
-    dossier_data["tokens_total"] = dossier_data.get("tokens_total", 0) + tokens["total"]
-    dossier_data["tokens_cost"] = dossier_data.get("tokens_cost", 0) + tokens["cost"]
+# Перенос строк из reports.xlsx прежних версий в журнал, чтобы выгрузка их не потеряла
+def migrate_xlsx_report():
+    if not os.path.exists(REPORTS_FILE) or report_journal_files():
+        return
+    base, ext = os.path.splitext(REPORTS_JOURNAL)
+    legacy_journal = f"{base}-00000000-000000{ext}"
+    import openpyxl
+    workbook = openpyxl.load_workbook(REPORTS_FILE, read_only=True)
+    with open(legacy_journal, "w", encoding="utf-8", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(REPORT_HEADERS)
+        for row in workbook.active.iter_rows(min_row=2, values_only=True):
+            writer.writerow(["" if value is None else value for value in row])
+    workbook.close()
+    print(f"Строки из {REPORTS_FILE} перенесены в журнал {legacy_journal}.")
 
-    with open(dossier_file, "w", encoding="utf-8") as file:
-        json.dump(dossier_data, file, ensure_ascii=False)
+# Очередь процесса-исполнителя в супервизор (строки отчёта и пересылаемые события);
+# в режиме нескольких процессов журнал пишет только супервизор
+report_queue = None
 
-# Запись в отчёт в формате .xlsx
+# Запись в отчёт: одна строка в конец журнала
 def log_report(account_id, account_name, message, recipient_id, recipient_name, tokens):
     timestamp = datetime.now().strftime("%A %d %B %Y, %H:%M:%S")
     entity_type = "group" if str(account_id).startswith("-") else "user"
 
     message = message.replace("\n", " ").replace("\r", " ")
 
-    headers = ["timestamp", "account_id", "account_name", "entity_type", "message", "recipient_id", "recipient_name", "tokens_in", "tokens_out", "tokens_total", "tokens_cost"]
     report_line = [
         timestamp, account_id, account_name, entity_type, message, recipient_id, recipient_name,
         tokens["input"], tokens["output"], tokens["total"], tokens["cost"]
     ]
-
-    if os.path.exists(REPORTS_FILE):
-        workbook = openpyxl.load_workbook(REPORTS_FILE)
-        sheet = workbook.active
+    if report_queue is not None:
+        report_queue.put(("report", report_line))
     else:
-        workbook = openpyxl.Workbook()
-        sheet = workbook.active
-        for col_idx, header in enumerate(headers, 1):
-            sheet[f"{get_column_letter(col_idx)}1"] = header
+        append_report_line(report_line)
+
+def append_report_line(report_line):
+    with reports_lock:
+        rotate_report_journal()
+        is_new = not os.path.exists(REPORTS_JOURNAL)
+        with open(REPORTS_JOURNAL, "a", encoding="utf-8", newline="") as file:
+            writer = csv.writer(file)
+            if is_new:
+                writer.writerow(REPORT_HEADERS)
+            writer.writerow(report_line)
 
-    row = sheet.max_row + 1 if sheet.max_row > 1 else 2
-    for col_idx, value in enumerate(report_line, 1):
-        sheet[f"{get_column_letter(col_idx)}{row}"] = value
+# Приведение значений из CSV к числам для Excel
+def parse_report_value(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
 
-    workbook.save(REPORTS_FILE)
+# Выгрузка журнала в reports.xlsx в потоковом режиме (write_only), файл заменяется атомарно
+def export_reports():
+    with reports_lock:
+        files = report_journal_files()
+    import openpyxl
+    workbook = openpyxl.Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(REPORT_HEADERS)
+    rows = 1
+    numeric_columns = {"account_id", "recipient_id", "tokens_in", "tokens_out", "tokens_total", "tokens_cost"}
+    for journal_file in files:
+        with open(journal_file, "r", encoding="utf-8", newline="") as file:
+            reader = csv.reader(file)
+            header = next(reader, None)
+            for line in reader:
+                if rows >= XLSX_MAX_ROWS:
+                    print(f"Достигнут предел строк Excel, выгрузка {REPORTS_FILE} неполная.")
+                    break
+                sheet.append([parse_report_value(value) if column in numeric_columns else value for column, value in zip(header, line)])
+                rows += 1
+    temp_file = f"{REPORTS_FILE}.tmp"
+    workbook.save(temp_file)
+    os.replace(temp_file, REPORTS_FILE)
+    print(f"Отчёт {REPORTS_FILE} обновлён: {rows - 1} строк.")
+
+# Фоновая выгрузка: перестраивает reports.xlsx, только если журнал изменился
+def reports_exporter():
+    last_state = None
+    while True:
+        time.sleep(REPORTS_EXPORT_INTERVAL)
+        try:
+            with reports_lock:
+                state = [(f, os.path.getmtime(f)) for f in report_journal_files()]
+            if state and state != last_state:
+                export_reports()
+                last_state = state
+        except Exception as e:
+            print(f"Ошибка выгрузки отчёта: {e}")
+
+# Запрос к OpenAI с учётом лимитов запросов и токенов в минуту
+def create_completion(ctx, prompt, max_tokens=OPENAI_MAX_TOKENS, **kwargs):
+    if RATE_LIMIT_ENABLED:
+        requests_limiter, tokens_limiter = get_openai_rate_limiters(ctx.config["DEFAULT"]["openai-token"])
+        requests_limiter.acquire(priority=PRIORITY_SEND)
+        tokens_limiter.acquire(amount=sum(count_message_tokens(msg) for msg in prompt) + max_tokens, priority=PRIORITY_SEND)
+    # Для потокового ответа длительность — до начала ответа, время до первого токена — этап first_token
+    started = time.perf_counter()
+    try:
+        response = ctx.client.chat.completions.create(model=OPENAI_MODEL, messages=prompt, max_tokens=max_tokens, **kwargs)
+    except Exception as e:
+        record_api_call("openai", "chat.completions", started, e)
+        raise
+    record_api_call("openai", "chat.completions", started)
+    return response
+
+# Подсчёт токенов и стоимости ответа по данным usage от OpenAI
+def tokens_from_usage(usage):
+    input_tokens = usage.prompt_tokens
+    output_tokens = usage.completion_tokens
+    return {
+        "input": input_tokens,
+        "output": output_tokens,
+        "total": usage.total_tokens,
+        "cost": (input_tokens * 0.15 / 1000000) + (output_tokens * 0.6 / 1000000)
+    }
 
 # Имитация печати
 def simulate_typing(vk, peer_id, text_length):
-    typing_duration = text_length // 3
+    with metrics.span("typing"):
+        _simulate_typing(vk, peer_id, text_length)
+
+def _simulate_typing(vk, peer_id, text_length):
+    typing_duration = text_length // TYPING_CHARS_PER_SECOND
     print(f"Имитирую печать на {typing_duration} секунд...")
     elapsed = 0
     while elapsed < typing_duration:
-        vk.messages.setActivity(peer_id=peer_id, type='typing')
-        time.sleep(5)
-        elapsed += 5
+        try:
+            vk.messages.setActivity(peer_id=peer_id, type='typing')
+        except RateLimitShed:
+            pass
+        time.sleep(TYPING_REFRESH)
+        elapsed += TYPING_REFRESH
         print(f"Имитирую печать... прошло {elapsed} секунд.")
 
+# Статус «печатает» в фоне: обновляется каждые TYPING_REFRESH секунд, пока не вызван stop()
+class TypingIndicator:
+    def __init__(self, vk, peer_id):
+        self.vk = vk
+        self.peer_id = peer_id
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                self.vk.messages.setActivity(peer_id=self.peer_id, type='typing')
+            except RateLimitShed:
+                pass
+            except Exception as e:
+                print(f"Ошибка установки статуса «печатает»: {e}")
+            self.stopped.wait(TYPING_REFRESH)
+
+# Отделение готовой части ответа по последней границе предложения;
+# возвращает (готовая часть, остаток) или (None, text), если отделять пока нечего
+def split_complete_part(text, min_chars=STREAM_SPLIT_MIN_CHARS):
+    cut = None
+    for match in SENTENCE_END.finditer(text):
+        if match.end() >= min_chars:
+            cut = match.end()
+    if cut is None:
+        return None, text
+    return text[:cut].strip(), text[cut:]
+
+# Отправка сообщения собеседнику и добавление его в кэш истории
+def send_reply(ctx, peer_id, text):
+    cleaned_reply = clean_message(text)
+    # random_id один на все попытки: если сообщение уже дошло до VK, повтор он отбросит как дубликат
+    random_id = random.getrandbits(31)
+    with metrics.span("send"):
+        sent_id = vk_retry.call(lambda: ctx.vk.messages.send(
+            peer_id=peer_id,
+            message=cleaned_reply,
+            random_id=random_id,
+            group_id=ctx.group_id if ctx.group_id else None
+        ))
+    history_cache.add((str(ctx.entity_id), peer_id), {
+        "id": sent_id if isinstance(sent_id, int) else None,
+        "from_id": int(ctx.entity_id),
+        "text": cleaned_reply,
+        "date": int(time.time()),
+    })
+    return cleaned_reply
+
+# Ответ без потоковой передачи: дождаться ответа OpenAI целиком, «напечатать» и отправить
+def generate_and_send(ctx, peer_id, prompt):
+    response = create_completion(ctx, prompt)
+    reply = response.choices[0].message.content
+    simulate_typing(ctx.vk, peer_id, len(reply))
+    send_reply(ctx, peer_id, reply)
+    return reply, tokens_from_usage(response.usage)
+
+# Потоковый ответ: статус «печатает» включается с первым токеном, а пауза перед отправкой
+# сокращается на время, которое уже ушло на генерацию. При STREAM_SPLIT_MESSAGES готовые
+# предложения отправляются отдельными сообщениями, пока остальной текст ещё генерируется.
+def stream_and_send(ctx, peer_id, prompt):
+    started = time.monotonic()
+    stream = create_completion(ctx, prompt, stream=True, stream_options={"include_usage": True})
+    typing = TypingIndicator(ctx.vk, peer_id)
+    parts = []
+    buffer = ""
+    usage = None
+    typing_since = None
+
+    def send_part(text):
+        nonlocal typing_since
+        delay = len(text) / TYPING_CHARS_PER_SECOND - (time.monotonic() - typing_since)
+        if delay > 0:
+            time.sleep(delay)
+        parts.append(send_reply(ctx, peer_id, text))
+        typing_since = time.monotonic()
+
+    try:
+        for chunk in stream:
+            if getattr(chunk, "usage", None):
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if typing_since is None:
+                typing_since = time.monotonic()
+                typing.start()
+                metrics.observe("stage_seconds", typing_since - started, stage="first_token")
+                print(f"Первый токен ответа через {typing_since - started:.2f} с.")
+            buffer += chunk.choices[0].delta.content
+            if STREAM_SPLIT_MESSAGES:
+                part, buffer = split_complete_part(buffer)
+                if part:
+                    send_part(part)
+        if buffer.strip():
+            send_part(buffer.strip())
+    finally:
+        typing.stop()
+
+    reply = " ".join(parts)
+    if usage:
+        tokens_data = tokens_from_usage(usage)
+    else:
+        # Без usage в потоке токены считаем локально
+        input_tokens = sum(count_message_tokens(msg) for msg in prompt)
+        output_tokens = count_tokens(reply)
+        tokens_data = {"input": input_tokens, "output": output_tokens, "total": input_tokens + output_tokens,
+                       "cost": (input_tokens * 0.15 / 1000000) + (output_tokens * 0.6 / 1000000)}
+    print(f"Ответ отправлен за {time.monotonic() - started:.1f} с, сообщений: {len(parts)}.")
+    return reply, tokens_data
+
 # Очистка сообщения от символов **
 def clean_message(message):
     return message.replace("**", "")
 
-# Статус онлайн
-def keep_online(vk):
+# Статус онлайн для всех пользовательских аккаунтов процесса (у сообществ статуса онлайн нет)
+def keep_online(engine):
     while True:
-        try:
-            vk.account.setOnline()
-            print("Статус установлен на онлайн.")
-        except Exception as e:
-            print(f"Ошибка при установке статуса онлайн: {e}")
-        time.sleep(300)
+        for ctx in engine.running_accounts():
+            if ctx.group_id:
+                continue
+            try:
+                ctx.vk.account.setOnline()
+                print(f"Статус установлен на онлайн: {ctx.entity_name}.")
+            except RateLimitShed as e:
+                print(f"Статус онлайн не обновлён: {e}")
+            except Exception as e:
+                print(f"Ошибка при установке статуса онлайн для {ctx.entity_name}: {e}")
+        time.sleep(ONLINE_INTERVAL)
 
-# Основная функция
-def main():
-    session_file = scan_sessions()
-    if not session_file:
-        print("Ошибка выбора или создания сессии.")
+# Диспетчер событий: отдельная очередь на каждого собеседника и общий пул потоков.
+# События одного собеседника обрабатываются строго по порядку, разные собеседники — параллельно.
+# Серия сообщений собеседника собирается, пока он не замолчит на COALESCE_QUIET_PERIOD секунд,
+# и передаётся обработчику целиком; сообщения, пришедшие во время ответа, ждут следующей серии.
+class PeerDispatcher:
+    def __init__(self, handler, workers=WORKER_THREADS, max_pending=MAX_PENDING_EVENTS, peer_limit=PEER_QUEUE_LIMIT,
+                 quiet_period=COALESCE_QUIET_PERIOD, max_wait=COALESCE_MAX_WAIT, group_limit=None):
+        self.handler = handler
+        # Ключ события — пара (группа, собеседник); одновременно обслуживается не больше group_limit
+        # собеседников одной группы (аккаунта), остальные ждут, не занимая потоки пула
+        self.group_limit = group_limit
+        self.active_groups = {}   # группа -> число обрабатываемых сейчас собеседников
+        self.blocked = {}         # группа -> deque собеседников, ожидающих освобождения места
+        self.max_pending = max_pending
+        self.peer_limit = peer_limit
+        self.quiet_period = quiet_period
+        self.max_wait = max_wait
+        self.queues = {}          # peer_id -> deque событий
+        self.arrivals = {}        # peer_id -> (время первого события серии, время последнего события)
+        self.scheduled = set()    # собеседники, ожидающие обработки или обрабатываемые
+        self.delayed = []         # куча (момент готовности, peer_id) для собеседников, у которых идёт серия
+        self.ready = queue.Queue()
+        self.pending = 0
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self._timer, name="peer-timer", daemon=True)]
+        for idx in range(workers):
+            self.threads.append(threading.Thread(target=self._worker, name=f"peer-worker-{idx + 1}", daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    # Постановка события в очередь; при переполнении ждём не дольше timeout, чтобы не задерживать LongPoll
+    def submit(self, peer_id, event, timeout=SUBMIT_TIMEOUT):
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.pending < self.max_pending, timeout):
+                return False
+            peer_queue = self.queues.setdefault(peer_id, deque())
+            if len(peer_queue) >= self.peer_limit:
+                peer_queue.popleft()
+                print(f"Очередь собеседника {peer_id} переполнена, самое старое событие отброшено.")
+            else:
+                self.pending += 1
+            peer_queue.append(event)
+            now = time.monotonic()
+            first_arrival = self.arrivals[peer_id][0] if peer_id in self.arrivals else now
+            self.arrivals[peer_id] = (first_arrival, now)
+            if peer_id not in self.scheduled:
+                self.scheduled.add(peer_id)
+                self._delay(peer_id)
+        return True
+
+    def pending_count(self):
+        with self.condition:
+            return self.pending
+
+    # Момент, когда серию собеседника пора обрабатывать: после паузы, но не позже max_wait от её начала
+    def _due(self, peer_id):
+        first_arrival, last_arrival = self.arrivals[peer_id]
+        return min(last_arrival + self.quiet_period, first_arrival + self.max_wait)
+
+    def _delay(self, peer_id):
+        heapq.heappush(self.delayed, (self._due(peer_id), peer_id))
+        self.condition.notify_all()
+
+    # Поток-таймер: переводит собеседников, у которых закончилась серия, в очередь готовых
+    def _timer(self):
+        with self.condition:
+            while True:
+                if not self.delayed:
+                    self.condition.wait()
+                    continue
+                due, peer_id = self.delayed[0]
+                now = time.monotonic()
+                if due > now:
+                    self.condition.wait(due - now)
+                    continue
+                heapq.heappop(self.delayed)
+                actual_due = self._due(peer_id)
+                if actual_due > now:
+                    heapq.heappush(self.delayed, (actual_due, peer_id))
+                else:
+                    self.ready.put(peer_id)
+
+    # Поток-обработчик: забирает всю накопленную серию собеседника и передаёт её обработчику
+    def _worker(self):
+        while True:
+            peer_id = self.ready.get()
+            group = peer_id[0] if self.group_limit else None
+            with self.condition:
+                if group is not None:
+                    if self.active_groups.get(group, 0) >= self.group_limit:
+                        self.blocked.setdefault(group, deque()).append(peer_id)
+                        continue
+                    self.active_groups[group] = self.active_groups.get(group, 0) + 1
+                events = list(self.queues[peer_id])
+                self.queues[peer_id].clear()
+                del self.arrivals[peer_id]
+                self.pending -= len(events)
+                self.condition.notify_all()
+            try:
+                self.handler(peer_id, events)
+            except Exception as e:
+                print(f"Ошибка обработки событий собеседника {peer_id}: {e}")
+            with self.condition:
+                if group is not None:
+                    self.active_groups[group] -= 1
+                    if not self.active_groups[group]:
+                        del self.active_groups[group]
+                    blocked = self.blocked.get(group)
+                    if blocked:
+                        self.ready.put(blocked.popleft())
+                        if not blocked:
+                            del self.blocked[group]
+                if self.queues[peer_id]:
+                    self._delay(peer_id)
+                else:
+                    del self.queues[peer_id]
+                    self.scheduled.discard(peer_id)
+
+# Кэш истории диалогов: кольцевой буфер последних сообщений на каждого собеседника.
+# Заполняется один раз через getHistory, дальше пополняется событиями LongPoll и нашими ответами.
+class HistoryCache:
+    def __init__(self, max_peers=HISTORY_CACHE_PEERS, limit=HISTORY_LIMIT):
+        self.max_peers = max_peers
+        self.limit = limit
+        self.peers = OrderedDict()  # (аккаунт, peer_id) -> {"seeded", "messages", "ids"}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, key):
+        entry = self.peers.get(key)
+        if entry is None:
+            entry = self.peers[key] = {"seeded": False, "messages": deque(maxlen=self.limit), "ids": set()}
+            while len(self.peers) > self.max_peers:
+                self.peers.popitem(last=False)
+        self.peers.move_to_end(key)
+        return entry
+
+    def _append(self, entry, msg):
+        if msg["id"] is not None and msg["id"] in entry["ids"]:
+            return False
+        if len(entry["messages"]) == entry["messages"].maxlen:
+            entry["ids"].discard(entry["messages"][0]["id"])
+        entry["messages"].append(msg)
+        if msg["id"] is not None:
+            entry["ids"].add(msg["id"])
+        return True
+
+    # Новое сообщение из LongPoll или отправленный нами ответ; повторы по message_id игнорируются
+    def add(self, key, msg):
+        with self.lock:
+            added = self._append(self._entry(key), msg)
+        if added and HISTORY_PERSIST:
+            get_storage().save_history(key[0], key[1], [msg])
+
+    # История диалога от старых сообщений к новым. При первом обращении загружается через loader,
+    # и к ней присоединяются сообщения, пришедшие из LongPoll, пока шла загрузка.
+    def get(self, key, loader):
+        with self.lock:
+            entry = self.peers.get(key)
+            if entry and entry["seeded"]:
+                self.peers.move_to_end(key)
+                self.hits += 1
+                return list(entry["messages"])
+            self.misses += 1
+        seed = get_storage().load_history(*key) if HISTORY_PERSIST else []
+        if not seed:
+            seed = loader()
+            if HISTORY_PERSIST:
+                get_storage().save_history(key[0], key[1], seed)
+        with self.lock:
+            entry = self._entry(key)
+            known = {msg["id"] for msg in seed}
+            merged = seed + [msg for msg in entry["messages"] if msg["id"] is None or msg["id"] not in known]
+            merged.sort(key=lambda msg: (msg["date"], msg["id"] or 0))
+            entry["messages"].clear()
+            entry["ids"].clear()
+            for msg in merged:
+                self._append(entry, msg)
+            entry["seeded"] = True
+            return list(entry["messages"])
+
+    def stats(self):
+        with self.lock:
+            return {"peers": len(self.peers), "hits": self.hits, "misses": self.misses}
+
+history_cache = HistoryCache()
+
+# Текст сообщения из LongPoll приходит с HTML-экранированием и <br> вместо переводов строки
+def decode_longpoll_text(text):
+    return html.unescape(text.replace("<br>", "\n"))
+
+# Событие о новом сообщении — одно для всех источников (LongPoll пользователя, Bots Long Poll,
+# догрузка пропущенного): отправитель уже известен, обработке не нужны дополнительные запросы
+def message_event(message_id, peer_id, from_id, timestamp, text, out=False):
+    return {"message_id": int(message_id), "peer_id": int(peer_id), "from": int(from_id),
+            "timestamp": int(timestamp), "text": text, "out": bool(out)}
+
+# Идентификатор из полного объекта сообщения. В беседах, где сообществу недоступна вся переписка,
+# id равен 0 — тогда он строится из peer_id и conversation_message_id, отрицательным, чтобы не совпасть с настоящими
+def message_id_of(message):
+    if message.get("id"):
+        return message["id"]
+    return -(message["peer_id"] * 10 ** 8 + message.get("conversation_message_id", 0))
+
+def event_from_message(message):
+    return message_event(message_id_of(message), message["peer_id"], message["from_id"], message["date"],
+                         message.get("text", ""), message.get("out"))
+
+# Данные аккаунта, общие для LongPoll-потока и потоков-обработчиков
+class AccountContext:
+    def __init__(self, session_file, config, batcher, openai_token, group_id, entity_id, entity_name, stopped=None):
+        self.session_file = session_file
+        self.name = os.path.basename(session_file)
+        self.stopped = stopped or threading.Event()
+        self.config = config
+        self.batcher = batcher
+        self.vk = batcher.get_api()
+        self.openai_token = openai_token
+        self.group_id = group_id
+        self.entity_id = entity_id
+        self.entity_name = entity_name
+        self.prompt_builder = PromptBuilder(config, entity_id)
+        # Кэш ответов включается для каждой сессии отдельно; ответы общие у сессий с одинаковым контекстом
+        self.reply_cache_enabled = config["DEFAULT"].getboolean("reply-cache", fallback=False)
+        self.reply_cache_threshold = config["DEFAULT"].getfloat("reply-cache-threshold", fallback=REPLY_CACHE_THRESHOLD)
+        context = f"{config['DEFAULT'].get('commercial-info', '')}\n{config['DEFAULT'].get('conversation-rules', '')}"
+        self.reply_cache_context = hashlib.sha1(context.encode("utf-8")).hexdigest()
+
+    # Клиент OpenAI создаётся при первом ответе, а не при запуске сессии
+    @property
+    def client(self):
+        return get_openai_client(self.openai_token)
+
+    # Освобождение потоков аккаунта, когда он больше не обслуживается
+    def close(self):
+        self.batcher.close()
+
+    def __repr__(self):
+        return self.name
+
+# Обработка серии входящих сообщений собеседника: выполняется в потоке-обработчике диспетчера.
+# Каждое сообщение сначала захватывается в базе, поэтому повторно доставленное (догрузка после
+# перезапуска, переподключение LongPoll, перебалансировка процессов) второй ответ не получает.
+# Обработанными сообщения отмечаются только после отправки ответа или намеренного пропуска;
+# если ответить не удалось, захват остаётся и истекает через MESSAGE_CLAIM_TIMEOUT.
+def handle_messages(ctx, peer_id, events):
+    now = time.time()
+    for event in events:
+        if "received_at" in event:
+            metrics.observe("stage_seconds", now - event["received_at"], stage="queue")
+    db = get_storage()
+    events = [event for event in events if db.claim_message(ctx.name, event["message_id"])]
+    if not events:
         return
-    config = configparser.ConfigParser()
-    config.read(session_file, encoding="utf-8")
-    vk_token = config["DEFAULT"]["vk-token"]
-    openai_token = config["DEFAULT"]["openai-token"]
-    group_id = config["DEFAULT"].get("group-id", "")
-
-    required_fields = {"tokens_in": "0", "tokens_out": "0", "tokens_total": "0", "tokens_cost": "0"}
-    for field, default in required_fields.items():
-        if field not in config["DEFAULT"]:
-            config["DEFAULT"][field] = default
-    with open(session_file, "w", encoding="utf-8") as configfile:
-        config.write(configfile)
+    with metrics.span("handle"):
+        handled = respond_to_messages(ctx, peer_id, events)
+    if handled:
+        db.finish_messages(ctx.name, [event["message_id"] for event in events])
+
+# Ответ на серию сообщений. Возвращает True, если ответ отправлен или отвечать не нужно, False — если отправить не удалось
+def respond_to_messages(ctx, peer_id, events):
+    vk = ctx.vk
+    group_id = ctx.group_id
+    entity_id = ctx.entity_id
+
+    accepted = []
+    for event in events:
+        user_id = event["from"]
+        if event["out"] or user_id == int(entity_id):
+            continue
+
+        with metrics.span("profile"):
+            sender_info = get_user_profile(vk, entity_id, user_id)
+        if group_id:
+            if peer_id < 2000000000:
+                if str(peer_id) != str(sender_info["id"]):
+                    continue
+            elif peer_id >= 2000000000:
+                members = get_chat_members(vk, entity_id, peer_id - 2000000000)
+                if int(entity_id) not in members:
+                    continue
+
+        print(f"Получено новое сообщение от {sender_info['first_name']} {sender_info['last_name']} (ID: {user_id}): {event['text']}")
+        accepted.append((user_id, sender_info, event["text"]))
+    if not accepted:
+        return True
+    # На всю серию отвечаем одним сообщением — последнему написавшему; история содержит всю серию
+    user_id, sender_info, _ = accepted[-1]
+    sender_name = sender_info["first_name"] + " " + sender_info["last_name"]
+    if len(accepted) > 1:
+        print(f"Серия из {len(accepted)} сообщений в диалоге {peer_id} объединена в один ответ.")
+
+    with metrics.span("partner"):
+        partner_info = get_conversation_partner_info(vk, user_id, entity_id)
+    if not partner_info:
+        log_report(entity_id, ctx.entity_name, "", user_id, sender_name, {"input": 0, "output": 0, "total": 0, "cost": 0})
+        return True
 
-    client = OpenAI(api_key=openai_token)
-    vk_session = vk_api.VkApi(token=vk_token)
-    vk = vk_session.get_api()
+    # Типовой вопрос получает готовый ответ без загрузки истории и обращения к OpenAI
+    question = normalize_question(" ".join(text for sender_id, _, text in accepted if sender_id == user_id))
+    use_reply_cache = (ctx.reply_cache_enabled and len(question) <= REPLY_CACHE_MAX_CHARS
+                       and len(question.split()) >= REPLY_CACHE_MIN_WORDS)
+    if use_reply_cache:
+        cached = reply_cache.lookup(ctx.reply_cache_context, question, ctx.reply_cache_threshold)
+        update_reply_cache_stats(ctx.session_file, bool(cached), cached[1] if cached else None)
+        if cached:
+            reply, _, similarity = cached
+            sent = False
+            try:
+                simulate_typing(vk, peer_id, len(reply))
+                send_reply(ctx, peer_id, reply)
+                sent = True
+                log_report(entity_id, ctx.entity_name, reply, user_id, sender_name, {"input": 0, "output": 0, "total": 0, "cost": 0})
+                print(f"Ответ из кэша (сходство {similarity:.0%}): {reply}")
+            except Exception as e:
+                print(f"Ошибка отправки сообщения: {e}")
+            return sent
 
-    longpoll_params = {"access_token": vk_token, "v": "5.131"}
+    history_params = {"peer_id": peer_id, "count": HISTORY_LIMIT}
     if group_id:
-        longpoll_params["group_id"] = group_id
-    server_info = vk.messages.getLongPollServer(**longpoll_params)
-    server = f"https://{server_info['server']}"
-    key = server_info["key"]
-    ts = server_info["ts"]
+        history_params["group_id"] = group_id
+    with metrics.span("history"):
+        conversation_history = history_cache.get((str(entity_id), peer_id), lambda: [
+            {"id": message_id_of(msg), "from_id": msg["from_id"], "text": msg["text"], "date": msg["date"]}
+            for msg in network_retry.call(lambda: vk.messages.getHistory(**history_params))["items"]])
+    if not conversation_history:
+        print("Не удалось загрузить историю сообщений.")
+        return False
 
+    # Краткое содержание ранней переписки ведётся только для личных диалогов
+    use_summary = PROMPT_SUMMARY_ENABLED and peer_id < 2000000000
+    summary = (get_storage().get_dossier(user_id) or {}).get("history_summary", "") if use_summary else ""
+    with metrics.span("prompt"):
+        prompt, dropped = ctx.prompt_builder.build(conversation_history, partner_info, summary)
+    if use_summary and dropped:
+        schedule_history_summary(ctx, user_id, dropped)
+    sent = False
+    try:
+        with metrics.span("reply"):
+            if OPENAI_STREAMING:
+                reply, tokens_data = stream_and_send(ctx, peer_id, prompt)
+            else:
+                reply, tokens_data = generate_and_send(ctx, peer_id, prompt)
+        sent = True
+
+        with metrics.span("report"):
+            update_session_tokens(ctx.session_file, tokens_data)
+            update_dossier_tokens(user_id, tokens_data)
+            log_report(entity_id, ctx.entity_name, reply, user_id, sender_name, tokens_data)
+        print(f"Ответ от OpenAI: {reply}")
+        # В кэш попадают только ответы на вопрос, с которого начался диалог: ответ с учётом прежних
+        # реплик или с обращением по имени адресован конкретному собеседнику и другим не подходит
+        fresh_question = not summary and not any(message["role"] == "assistant" for message in prompt)
+        if use_reply_cache and fresh_question and sender_info["first_name"].lower() not in reply.lower():
+            reply_cache.store(ctx.reply_cache_context, question, reply, tokens_data)
+    except Exception as e:
+        print(f"Ошибка отправки сообщения: {e}")
+    return sent
+
+# Клиенты OpenAI по ключу; соединения у всех общие
+openai_clients = {}
+openai_clients_lock = threading.Lock()
+
+def get_openai_client(openai_token):
+    with openai_clients_lock:
+        if openai_token not in openai_clients:
+            from openai import OpenAI
+            openai_clients[openai_token] = OpenAI(api_key=openai_token, base_url=OPENAI_BASE_URL,
+                                                  http_client=get_openai_http_client())
+        return openai_clients[openai_token]
+
+# Подготовка аккаунта: чтение сессии, клиенты API и данные о самом аккаунте.
+# Имя группы и данные страницы запрашиваются один раз и сохраняются в сессии, поэтому при
+# перезапуске аккаунт сразу переходит к опросу LongPoll. Данные страницы привязаны к отпечатку
+# ключа VK: после замены ключа они запрашиваются заново.
+def load_account(session_file, stopped=None):
+    config = configparser.ConfigParser()
+    config.read(session_file, encoding="utf-8")
+    defaults = config["DEFAULT"]
+    vk_token = defaults["vk-token"]
+    openai_token = defaults["openai-token"]
+    group_id = defaults.get("group-id", "")
+
+    vk_session = vk_api.VkApi(token=vk_token, session=http_session)
+    shared = defaults.getboolean("shard-peers", fallback=False)
+    batcher = VkBatcher(vk_session, get_vk_rate_limiter(vk_token, group_id, shared))
+    try:
+        entity_id, entity_name = load_entity(session_file, config, batcher.get_api())
+    except Exception:
+        batcher.close()
+        raise
+    return AccountContext(session_file, config, batcher, openai_token, group_id, entity_id, entity_name, stopped)
+
+# Данные группы или страницы из сессии; если их там нет или ключ сменился — запрос к VK и запись в сессию
+def load_entity(session_file, config, vk):
+    defaults = config["DEFAULT"]
+    group_id = defaults.get("group-id", "")
+    vk_token = defaults["vk-token"]
+    changed = False
     if group_id:
         entity_id = f"-{group_id}"
-        entity_name = config["DEFAULT"].get("group-name")
+        entity_name = defaults.get("group-name")
         if not entity_name:
             group_info = vk.groups.getById(group_id=group_id)[0]
             entity_name = group_info["name"]
-            config["DEFAULT"]["group-name"] = entity_name
-            with open(session_file, "w", encoding="utf-8") as configfile:
-                config.write(configfile)
-        print(f"LongPoll активирован для группы {entity_name} (ID: {group_id})")
+            defaults["group-name"] = entity_name
+            changed = True
     else:
-        user_info = vk.users.get(user_ids=vk.users.get()[0]['id'], fields="first_name,last_name")[0]
-        entity_id = user_info['id']
-        entity_name = f"{user_info['first_name']} {user_info['last_name']}"
-        print(f"LongPoll активирован для {entity_name} (ID: {entity_id})")
+        token_hash = hashlib.sha1(vk_token.encode("utf-8")).hexdigest()[:16]
+        if defaults.get("entity-id") and defaults.get("entity-token") == token_hash:
+            entity_id = int(defaults["entity-id"])
+            entity_name = defaults.get("entity-name", "")
+        else:
+            user_info = vk.users.get(fields="first_name,last_name")[0]
+            entity_id = user_info['id']
+            entity_name = f"{user_info['first_name']} {user_info['last_name']}"
+            defaults["entity-id"] = str(entity_id)
+            defaults["entity-name"] = entity_name
+            defaults["entity-token"] = token_hash
+            changed = True
+    if changed:
+        with open(session_file, "w", encoding="utf-8") as configfile:
+            config.write(configfile)
+    return entity_id, entity_name
+
+# Приём нового сообщения: запись в кэш истории и постановка в очередь обработки
+def accept_event(ctx, dispatcher, peer_id, event):
+    entity_id = int(ctx.entity_id)
+    event["received_at"] = time.time()
+    history_cache.add((str(entity_id), peer_id), {
+        "id": event["message_id"], "from_id": event["from"], "text": event["text"], "date": event["timestamp"]})
+    if event["out"] or event["from"] == entity_id:
+        return
+    if not dispatcher.submit((ctx, peer_id), event):
+        print(f"Очередь обработки переполнена, сообщение {event['message_id']} от {peer_id} ({ctx.name}) отброшено.")
 
-    online_thread = threading.Thread(target=keep_online, args=(vk,), daemon=True)
-    online_thread.start()
+# Догрузка пропущенных сообщений начиная с pts через messages.getLongPollHistory. События идут
+# тем же путём, что и из LongPoll, но не быстрее CATCHUP_RATE; уже обработанные пропускаются сразу.
+def catch_up_account(ctx, engine, pts):
+    db = get_storage()
+    params = {"pts": pts, "lp_version": 3, "events_limit": 1000, "msgs_limit": 200}
+    if ctx.group_id:
+        params["group_id"] = ctx.group_id
+    min_date = time.time() - CATCHUP_MAX_AGE if CATCHUP_MAX_AGE else 0
+    replayed = 0
+    while not ctx.stopped.is_set():
+        response = vk_retry.call(lambda: ctx.vk.messages.getLongPollHistory(**params))
+        for event in sorted((event_from_message(item) for item in response["messages"]["items"]),
+                            key=lambda event: (event["timestamp"], event["message_id"])):
+            if ctx.stopped.is_set():
+                break
+            incoming = not event["out"] and event["from"] != int(ctx.entity_id)
+            if incoming and (event["timestamp"] < min_date or db.is_processed(ctx.name, event["message_id"])):
+                continue
+            engine.deliver(ctx, event["peer_id"], event)
+            if incoming:
+                replayed += 1
+                ctx.stopped.wait(1 / CATCHUP_RATE)
+        if not response.get("more") or response.get("new_pts", params["pts"]) == params["pts"]:
+            break
+        params["pts"] = response["new_pts"]
+    if replayed:
+        print(f"Догружено пропущенных сообщений для {ctx.entity_name} ({ctx.name}): {replayed}.")
 
-    processing_peers = set()
+# Источник событий LongPoll пользователя (messages.getLongPollServer): события приходят массивами,
+# отправитель в беседах — в дополнительных полях. Используется для личных страниц и как запасной для групп.
+class UserLongPoll:
+    name = "LongPoll"
 
-    while True:
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.params = {"access_token": ctx.config["DEFAULT"]["vk-token"], "v": "5.131", "need_pts": 1, "lp_version": 3}
+        if ctx.group_id:
+            self.params["group_id"] = ctx.group_id
+        self.server = self.key = self.ts = self.pts = None
+        self.pts_at = None
+
+    def connect(self, keep_ts=False):
+        server_info = self.ctx.vk.messages.getLongPollServer(**self.params)
+        self.server = f"https://{server_info['server']}"
+        self.key = server_info["key"]
+        if not keep_ts or self.ts is None:
+            self.ts = server_info["ts"]
+        self.pts = server_info.get("pts", self.pts)
+
+    # Текущий pts без смены сервера: для догрузки пропущенного, если источник сам pts не сообщает
+    def refresh_pts(self):
+        if CATCHUP_ENABLED:
+            self.pts = self.ctx.vk.messages.getLongPollServer(**self.params).get("pts", self.pts)
+        self.pts_at = time.monotonic()
+
+    # Ответ сервера: failed 1 — часть истории событий потеряна, 2 — истёк ключ (ts ещё годен), 3 — потеряно всё.
+    # Возвращает pts, с которого нужно догрузить пропущенное, если события могли потеряться.
+    def recover(self, updates):
+        lost_pts = self.pts
+        if updates["failed"] == 1:
+            self.ts = updates["ts"]
+        else:
+            self.connect(keep_ts=updates["failed"] == 2)
+        return None if updates["failed"] == 2 else lost_pts
+
+    # Одна итерация опроса: (события, pts для догрузки или None)
+    def check(self):
+        # mode 2 — отправитель в дополнительных полях, 32 — pts в каждом ответе
+        response = network_retry.call(lambda: http_session.get(
+            f"{self.server}?act=a_check&key={self.key}&ts={self.ts}&wait={LONGPOLL_WAIT}&mode=34&version=3",
+            timeout=LONGPOLL_TIMEOUT))
+        updates = response.json()
+        if "failed" in updates:
+            return [], self.recover(updates)
+        self.ts = updates["ts"]
+        self.pts = updates.get("pts", self.pts)
+        return [self.decode(update) for update in updates["updates"] if update[0] == 4], None
+
+    def decode(self, update):
+        extra_fields = update[6] if len(update) > 6 else {}
+        peer_id = update[3]
+        outgoing = bool(update[2] & 2)
+        # В личном диалоге отправитель — либо собеседник, либо мы сами (флаг 2, исходящее)
+        from_id = extra_fields.get("from") or (self.ctx.entity_id if outgoing else peer_id)
+        return message_event(update[1], peer_id, from_id, update[4], decode_longpoll_text(update[5]), outgoing)
+
+# Источник событий Bots Long Poll (groups.getLongPollServer) для групп: message_new и message_reply
+# приходят полными объектами сообщений. Bots Long Poll не сообщает pts, поэтому для догрузки
+# pts запрашивается отдельно: после первого ответа сервера и затем не чаще раза в CATCHUP_OVERLAP
+# секунд. При подключении он не запрашивается, чтобы не задерживать первый опрос.
+class BotsLongPoll(UserLongPoll):
+    name = "Bots Long Poll"
+
+    def connect(self, keep_ts=False):
+        server_info = self.ctx.vk.groups.getLongPollServer(group_id=self.ctx.group_id)
+        self.server = server_info["server"]
+        self.key = server_info["key"]
+        if not keep_ts or self.ts is None:
+            self.ts = server_info["ts"]
+
+    def check(self):
+        response = network_retry.call(lambda: http_session.get(
+            f"{self.server}?act=a_check&key={self.key}&ts={self.ts}&wait={LONGPOLL_WAIT}", timeout=LONGPOLL_TIMEOUT))
+        updates = response.json()
+        if "failed" in updates:
+            return [], self.recover(updates)
+        events = []
+        for update in updates["updates"]:
+            if update["type"] in ("message_new", "message_reply"):
+                # До версии API 5.103 объект события — само сообщение, начиная с неё — {"message", "client_info"}
+                message = update["object"].get("message", update["object"])
+                events.append(event_from_message(message))
+        self.ts = updates["ts"]
+        # Сбой обновления pts не должен стоить полученных событий: прежний pts годится до следующей попытки
+        if self.pts_at is None or time.monotonic() - self.pts_at >= CATCHUP_OVERLAP:
+            try:
+                self.refresh_pts()
+            except Exception as e:
+                print(f"Не удалось обновить pts ({self.ctx.name}), повтор после следующего ответа: {e}")
+        return events, None
+
+# Группы опрашиваются через Bots Long Poll; если он выключен в настройках сообщества — через LongPoll сообщений
+def longpoll_source(ctx):
+    if ctx.group_id:
+        source = BotsLongPoll(ctx)
         try:
-            response = retry_request(lambda timeout: requests.get(
-                f"{server}?act=a_check&key={key}&ts={ts}&wait=25&mode=2&version=3", timeout=timeout))
-            updates = response.json()
-
-            if "failed" in updates:
-                server_info = vk.messages.getLongPollServer(**longpoll_params)
-                server = f"https://{server_info['server']}"
-                key = server_info["key"]
-                ts = server_info["ts"]
-                continue
+            source.connect()
+            return source
+        except vk_api.exceptions.ApiError as e:
+            print(f"Bots Long Poll недоступен для группы {ctx.entity_name}: {e}. Используется LongPoll сообщений.")
+    source = UserLongPoll(ctx)
+    source.connect()
+    return source
 
-            ts = updates["ts"]
-            for update in updates["updates"]:
-                if update[0] != 4:
-                    continue
+first_poll_at = None
+first_poll_lock = threading.Lock()
 
-                message_id = update[1]
-                flags = update[2]
-                peer_id = update[3]
-                timestamp = update[4]
-                text = update[5]
-                extra_fields = update[6] if len(update) > 6 else {}
-
-                user_id = extra_fields.get("from") if "from" in extra_fields else None
-                if not user_id:
-                    history_params = {"peer_id": peer_id, "count": 1}
-                    if group_id:
-                        history_params["group_id"] = group_id
-                    last_message = vk.messages.getHistory(**history_params)["items"][0]
-                    user_id = last_message["from_id"]
-
-                if user_id == int(entity_id):
-                    continue
+# Первый опрос LongPoll в процессе: время от запуска выводится в консоль и доступно в метрике startup_seconds
+def mark_first_poll():
+    global first_poll_at
+    with first_poll_lock:
+        if first_poll_at is not None:
+            return
+        first_poll_at = time.time()
+    print(f"От запуска до первого опроса LongPoll: {first_poll_at - STARTED_AT:.2f} с.")
+    # openai загружается в фоне, чтобы первый ответ не ждал импорта
+    threading.Thread(target=preload_openai, name="preload-openai", daemon=True).start()
 
-                if group_id:
-                    if peer_id < 2000000000:
-                        sender_info = vk.users.get(user_ids=user_id, fields="first_name,last_name")[0]
-                        if str(peer_id) != str(sender_info["id"]):
-                            continue
-                    elif peer_id >= 2000000000:
-                        chat_info = vk.messages.getChat(chat_id=peer_id - 2000000000, fields="members")
-                        members = [m["member_id"] for m in chat_info.get("members", [])]
-                        if int(entity_id) not in members:
-                            continue
-
-                if peer_id in processing_peers:
-                    print(f"Сообщение от {user_id} пропущено, так как уже обрабатывается предыдущее.")
-                    continue
+def preload_openai():
+    try:
+        import openai  # noqa: F401
+    except ImportError as e:
+        print(f"Не удалось загрузить openai: {e}")
 
-                processing_peers.add(peer_id)
-                try:
-                    sender_info = vk.users.get(user_ids=user_id, fields="first_name,last_name")[0]
-                    print(f"Получено новое сообщение от {sender_info['first_name']} {sender_info['last_name']} (ID: {user_id}): {text}")
-
-                    history_params = {"peer_id": peer_id, "count": 200}
-                    if group_id:
-                        history_params["group_id"] = group_id
-                    messages = retry_request(lambda timeout: vk.messages.getHistory(**history_params, timeout=timeout))["items"]
-                    if not messages:
-                        print("Не удалось загрузить историю сообщений.")
-                        continue
+# LongPoll-цикл аккаунта: принимает события и передаёт их движку, пока аккаунт не остановлен.
+# После каждой пачки событий курсор сохраняется в базе; после перезапуска или потери истории
+# на сервере пропущенное догружается с сохранённого pts.
+def poll_account(ctx, engine):
+    db = get_storage()
+    catching_up = threading.Event()
+    # pts сохраняется с отставанием на CATCHUP_OVERLAP: события, ещё стоящие в очереди при сбое, будут догружены
+    checkpoints = deque()
 
-                    conversation_history = [{"from_id": msg["from_id"], "text": msg["text"], "date": msg["date"]} for msg in messages]
-                    partner_info = get_conversation_partner_info(vk, user_id)
-                    if not partner_info:
-                        log_report(entity_id, entity_name, "", user_id, sender_info["first_name"] + " " + sender_info["last_name"], {"input": 0, "output": 0, "total": 0, "cost": 0})
-                        continue
-                    prompt = create_openai_prompt(config, conversation_history, partner_info, entity_id)
-                    try:
-                        response = client.chat.completions.create(model="gpt-4o-mini", messages=prompt, max_tokens=150)
-                        reply = response.choices[0].message.content
-                        input_tokens = response.usage.prompt_tokens
-                        output_tokens = response.usage.completion_tokens
-                        total_tokens = response.usage.total_tokens
-                        tokens_cost = (input_tokens * 0.15 / 1000000) + (output_tokens * 0.6 / 1000000)
-
-                        tokens_data = {
-                            "input": input_tokens,
-                            "output": output_tokens,
-                            "total": total_tokens,
-                            "cost": tokens_cost
-                        }
-
-                        simulate_typing(vk, peer_id, len(reply))
-                        cleaned_reply = clean_message(reply)
-                        # Используем retry_vk_request для отправки сообщения
-                        retry_vk_request(lambda: vk.messages.send(
-                            peer_id=peer_id,
-                            message=cleaned_reply,
-                            random_id=int(time.time() * 1000),
-                            group_id=group_id if group_id else None
-                        ))
-
-                        update_session_tokens(session_file, tokens_data)
-                        dossier_file = os.path.join(DOSSIER_DIR, f"{sender_info['first_name']}_{sender_info['last_name']}_{user_id}.json")
-                        update_dossier_tokens(dossier_file, tokens_data)
-                        log_report(entity_id, entity_name, reply, user_id, sender_info["first_name"] + " " + sender_info["last_name"], tokens_data)
-                        print(f"Ответ от OpenAI: {reply}")
-                    except Exception as e:
-                        print(f"Ошибка отправки сообщения: {e}")
-                finally:
-                    processing_peers.remove(peer_id)
+    def catch_up(from_pts):
+        if not CATCHUP_ENABLED or not from_pts or catching_up.is_set():
+            return
+        catching_up.set()
+
+        def run():
+            try:
+                catch_up_account(ctx, engine, from_pts)
+            except Exception as e:
+                print(f"Ошибка догрузки пропущенных сообщений ({ctx.name}): {e}")
+            finally:
+                catching_up.clear()
+        threading.Thread(target=run, name=f"catchup-{ctx.name}", daemon=True).start()
+
+    # Захваты, оставшиеся от упавшего процесса, снимаются: иначе эти сообщения не получат ответа ни
+    # при продолжении опроса с сохранённого ts, ни при догрузке
+    released = db.release_claims(ctx.name)
+    if released:
+        print(f"Сообщений, брошенных завершившимся процессом ({ctx.name}), будет обработано заново: {released}.")
+    source = longpoll_source(ctx)
+    cursor = db.get_cursor(ctx.name)
+    if cursor and cursor["ts"]:
+        # Опрос продолжается с сохранённого ts: события, пришедшие, пока процесс не работал, сервер отдаст сам.
+        # Если он их уже не хранит, ответ failed 1 или 3 запустит догрузку с pts.
+        source.ts = cursor["ts"]
+    if cursor and cursor["pts"]:
+        catch_up(cursor["pts"])
+    else:
+        # Первый запуск сессии: без pts догружать после сбоя будет не с чего
+        if source.pts is None:
+            source.refresh_pts()
+        db.save_cursor(ctx.name, source.ts, source.pts)
+    mark_first_poll()
+    if ctx.group_id:
+        print(f"{source.name} активирован для группы {ctx.entity_name} (ID: {ctx.group_id})")
+    else:
+        print(f"{source.name} активирован для {ctx.entity_name} (ID: {ctx.entity_id})")
+
+    while not ctx.stopped.is_set():
+        try:
+            with metrics.span("longpoll"):
+                events, lost_pts = source.check()
+            metrics.inc("events_total", len(events), source=source.name)
+            catch_up(lost_pts)
+            for event in events:
+                engine.deliver(ctx, event["peer_id"], event)
+
+            now = time.monotonic()
+            checkpoints.append((now, source.pts))
+            safe_pts = None
+            while checkpoints and now - checkpoints[0][0] >= CATCHUP_OVERLAP:
+                safe_pts = checkpoints.popleft()[1]
+            # Пока идёт догрузка, pts не сдвигается: при новом сбое она начнётся с того же места
+            db.save_cursor(ctx.name, source.ts, None if catching_up.is_set() else safe_pts)
         except (ConnectionError, ReadTimeout, Exception) as e:
-            print(f"Ошибка соединения или обработки: {e}")
-            retries = 0
-            backoff_factor = 1
+            print(f"Ошибка соединения или обработки ({ctx.name}): {e}")
+            lost_pts = source.pts
+
+            def reconnect():
+                source.connect()
+                catch_up(lost_pts)
+                print("Переподключение успешно.")
+            reconnect_retry.call(reconnect, stopped=ctx.stopped, wait_first=True)
+    print(f"LongPoll остановлен для {ctx.entity_name} ({ctx.name}).")
+
+# Файлы сессий в папке Sessions, подходящие под шаблоны имён
+def find_session_files(patterns):
+    files = set()
+    for pattern in patterns:
+        files.update(f for f in glob.glob(os.path.join(SESSIONS_DIR, pattern)) if f.endswith(".ini"))
+    return files
+
+# Движок нескольких аккаунтов: по LongPoll-потоку на каждую сессию, общие пул обработчиков,
+# хранилище и клиенты API. Папка Sessions периодически пересматривается: новые сессии запускаются,
+# удалённые останавливаются, изменённые перезапускаются без перезапуска процесса.
+class SessionEngine:
+    def __init__(self, patterns, workers=None, shard=None):
+        self.patterns = patterns
+        self.shard = shard  # ShardWorker, если процесс работает под супервизором
+        self.accounts = {}  # файл сессии -> {"thread", "stopped", "mtime", "ctx"}
+        self.remote_accounts = {}  # сессии других процессов, чьих собеседников обслуживает этот процесс: файл -> {"ctx", "mtime"}
+        self.lock = threading.Lock()
+        # Настройки читаются при создании движка, а не при загрузке модуля: их можно поменять до запуска
+        self.dispatcher = PeerDispatcher(lambda key, events: handle_messages(key[0], key[1], events),
+                                         workers=workers or WORKER_THREADS, max_pending=MAX_PENDING_EVENTS,
+                                         peer_limit=PEER_QUEUE_LIMIT, quiet_period=COALESCE_QUIET_PERIOD,
+                                         max_wait=COALESCE_MAX_WAIT, group_limit=ACCOUNT_MAX_CONCURRENCY)
+
+    # Событие из LongPoll: собеседники сессий с shard-peers распределяются по процессам
+    def deliver(self, ctx, peer_id, event):
+        if self.shard and ctx.config["DEFAULT"].getboolean("shard-peers", fallback=False):
+            owner = self.shard.owner(f"{ctx.name}:{peer_id}")
+            if owner != self.shard.index:
+                self.shard.forward(owner, ctx.session_file, peer_id, event)
+                return
+        accept_event(ctx, self.dispatcher, peer_id, event)
+
+    # Событие, переданное другим процессом; аккаунт поднимается здесь без собственного LongPoll.
+    # После изменения файла сессии он загружается заново, как и у процесса, который его опрашивает.
+    def deliver_forwarded(self, session_file, peer_id, event):
+        with self.lock:
+            entry = self.accounts.get(session_file)
+            ctx = entry["ctx"] if entry and entry["ctx"] and not entry["stopped"].is_set() else None
+            remote = self.remote_accounts.get(session_file)
+        if ctx is None:
+            if remote and remote["mtime"] == os.path.getmtime(session_file):
+                ctx = remote["ctx"]
+            else:
+                ctx = load_account(session_file)
+                # load_account может дописать в сессию имя группы — время изменения берётся после него
+                with self.lock:
+                    self.remote_accounts[session_file] = {"ctx": ctx, "mtime": os.path.getmtime(session_file)}
+                if remote:
+                    remote["ctx"].close()
+        accept_event(ctx, self.dispatcher, peer_id, event)
+
+    def session_files(self):
+        with self.lock:
+            return find_session_files(self.patterns)
+
+    def running_accounts(self):
+        with self.lock:
+            return [entry["ctx"] for entry in self.accounts.values() if entry["ctx"] and not entry["stopped"].is_set()]
+
+    def _run_account(self, session_file, entry):
+        try:
+            entry["ctx"] = load_account(session_file, entry["stopped"])
+            # load_account может дописать в сессию имя группы — это не повод для перезапуска
+            entry["mtime"] = os.path.getmtime(session_file)
+            poll_account(entry["ctx"], self)
+        except Exception as e:
+            print(f"Ошибка запуска сессии {os.path.basename(session_file)}: {e}")
+        finally:
+            if entry["ctx"]:
+                entry["ctx"].close()
+
+    def _start(self, session_file):
+        entry = {"stopped": threading.Event(), "mtime": os.path.getmtime(session_file), "ctx": None}
+        entry["thread"] = threading.Thread(target=self._run_account, args=(session_file, entry),
+                                           name=f"longpoll-{os.path.basename(session_file)}", daemon=True)
+        self.accounts[session_file] = entry
+        entry["thread"].start()
+        print(f"Сессия {os.path.basename(session_file)} запущена.")
+
+    def _stop(self, session_file, reason):
+        entry = self.accounts[session_file]
+        if not entry["stopped"].is_set():
+            entry["stopped"].set()
+            print(f"Сессия {os.path.basename(session_file)} останавливается: {reason}.")
+
+    # Сверка запущенных аккаунтов с файлами сессий
+    def sync(self):
+        files = self.session_files()
+        with self.lock:
+            for session_file, entry in list(self.accounts.items()):
+                alive = entry["thread"].is_alive()
+                if session_file not in files:
+                    self._stop(session_file, "файл удалён")
+                elif os.path.getmtime(session_file) != entry["mtime"]:
+                    self._stop(session_file, "файл изменён")
+                # Перезапуск только после того, как прежний поток завершился, чтобы не опрашивать LongPoll дважды
+                if not alive:
+                    del self.accounts[session_file]
+            for session_file in sorted(files - set(self.accounts)):
+                self._start(session_file)
+            # Удалённые сессии других процессов больше не обслуживаются
+            for session_file in [f for f in self.remote_accounts if not os.path.exists(f)]:
+                self.remote_accounts.pop(session_file)["ctx"].close()
+
+    def set_patterns(self, patterns):
+        with self.lock:
+            self.patterns = patterns
+        self.sync()
+
+    # primary=False — процесс под супервизором: перенос старых данных и выгрузку отчётов делает супервизор
+    def run(self, primary=True):
+        if METRICS_ENABLED:
+            metrics.gauge("dispatcher_pending", self.dispatcher.pending_count)
+            metrics.gauge("history_cache_peers", lambda: history_cache.stats()["peers"])
+            metrics.gauge("accounts_running", lambda: len(self.running_accounts()))
+            metrics.gauge("startup_seconds", lambda: first_poll_at - STARTED_AT if first_poll_at else 0)
+            if METRICS_PORT:
+                start_metrics_server(METRICS_PORT + (self.shard.index + 1 if self.shard else 0))
+        if primary:
+            migrate_legacy_files(get_storage())
+            migrate_xlsx_report()
+            if REPORTS_EXPORT_INTERVAL:
+                threading.Thread(target=reports_exporter, daemon=True).start()
+        threading.Thread(target=keep_online, args=(self,), daemon=True).start()
+        if STATS_INTERVAL:
+            threading.Thread(target=stats_reporter, daemon=True).start()
+        while True:
+            self.sync()
+            if not self.accounts and primary:
+                print("Нет сессий для запуска, ожидание новых файлов в папке Sessions.")
+            time.sleep(SESSIONS_RESCAN_INTERVAL)
+
+# Кольцо консистентного хеширования: ключ принадлежит первой точке кольца по часовой стрелке.
+# При исключении процесса переезжают только его ключи, остальные остаются на месте.
+class HashRing:
+    def __init__(self, members, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.points = sorted((self._hash(f"{member}#{idx}"), member) for member in members for idx in range(virtual_nodes))
+        self.hashes = [point[0] for point in self.points]
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+    def owner(self, key):
+        idx = bisect.bisect(self.hashes, self._hash(key)) % len(self.points)
+        return self.points[idx][1]
+
+# Сторона процесса-исполнителя: его номер, кольцо и очередь в супервизор, через которую события
+# пересылаются другим процессам
+class ShardWorker:
+    def __init__(self, index, outbox):
+        self.index = index
+        self.outbox = outbox
+        self.ring = HashRing([index])
+
+    def set_members(self, members):
+        self.ring = HashRing(members)
+        set_vk_rate_shares(len(members))
+
+    def owner(self, key):
+        return self.ring.owner(key)
+
+    def forward(self, owner, session_file, peer_id, event):
+        try:
+            self.outbox.put(("forward", owner, session_file, peer_id, event), timeout=SUBMIT_TIMEOUT)
+        except queue.Full:
+            print(f"Очередь процесса {self.index} переполнена, сообщение {event['message_id']} от {peer_id} отброшено.")
+
+# Точка входа процесса-исполнителя: список сессий и состав процессов приходят от супервизора.
+# Каждая очередь пишется одним процессом: control и inbox — супервизором, outbox — этим процессом.
+# Процесс, убитый посреди записи, оставляет занятой блокировку очереди — так она достаётся только
+# его собственным очередям, а их супервизор при перезапуске создаёт заново.
+def shard_worker(index, control, inbox, outbox):
+    global report_queue, storage_batched
+    report_queue = outbox
+    storage_batched = False
+    shard = ShardWorker(index, outbox)
+    engine = SessionEngine([], shard=shard)
+
+    def listen_control():
+        while True:
+            message = control.get()
+            shard.set_members(message["members"])
+            engine.set_patterns([glob.escape(session_file) for session_file in message["sessions"]])
+
+    def listen_inbox():
+        while True:
+            session_file, peer_id, event = inbox.get()
+            try:
+                engine.deliver_forwarded(session_file, peer_id, event)
+            except Exception as e:
+                print(f"Ошибка обработки пересланного события {os.path.basename(session_file)}: {e}")
+
+    threading.Thread(target=listen_control, daemon=True).start()
+    threading.Thread(target=listen_inbox, daemon=True).start()
+    print(f"Процесс {index} запущен (PID {os.getpid()}).")
+    engine.run(primary=False)
+
+# Супервизор: запускает процессы-исполнители, распределяет между ними сессии по кольцу
+# консистентного хеширования, перезапускает упавшие процессы и пишет общий журнал отчётов.
+class ShardSupervisor:
+    def __init__(self, patterns, processes):
+        self.patterns = patterns
+        self.mp = multiprocessing.get_context("spawn")
+        self.members = list(range(processes))
+        self.inboxes = {}   # номер процесса -> очереди, которые создаются заново при каждом его запуске
+        self.controls = {}
+        self.outboxes = {}
+        self.processes = {}
+        self.crashes = {index: deque() for index in self.members}
+        self.assignment = {}
+
+    def session_files(self):
+        return find_session_files(self.patterns)
+
+    def _assign(self):
+        ring = HashRing(self.members)
+        assignment = {index: [] for index in self.members}
+        for session_file in sorted(self.session_files()):
+            assignment[ring.owner(os.path.basename(session_file))].append(session_file)
+        return assignment
+
+    def _publish(self, index):
+        self.controls[index].put({"sessions": self.assignment.get(index, []), "members": self.members})
+
+    def _start(self, index):
+        self.inboxes[index] = self.mp.Queue(maxsize=MAX_PENDING_EVENTS)
+        self.controls[index] = self.mp.Queue()
+        self.outboxes[index] = outbox = self.mp.Queue()
+        process = self.mp.Process(target=shard_worker, args=(index, self.controls[index], self.inboxes[index], outbox),
+                                  name=f"vk-messager-{index}", daemon=True)
+        process.start()
+        self.processes[index] = process
+        threading.Thread(target=self._route, args=(index, outbox), daemon=True).start()
+        self._publish(index)
+
+    # Пересчёт распределения сессий; процессы получают новый список, только если он изменился
+    def rebalance(self, force=False):
+        assignment = self._assign()
+        if assignment != self.assignment or force:
+            self.assignment = assignment
+            for index in self.members:
+                self._publish(index)
+            print("Распределение сессий: " + ", ".join(f"процесс {index} — {len(files)}" for index, files in assignment.items()))
+
+    # Сообщения процесса-исполнителя: строки отчёта пишутся в журнал, события передаются владельцу собеседника.
+    # Поток дочитывает очередь и завершается, когда процесс перезапущен и у него новая очередь.
+    def _route(self, index, outbox):
+        while True:
+            try:
+                message = outbox.get(timeout=1)
+            except queue.Empty:
+                if self.outboxes.get(index) is not outbox:
+                    return
+                continue
+            try:
+                if message[0] == "report":
+                    append_report_line(message[1])
+                else:
+                    _, owner, session_file, peer_id, event = message
+                    self._forward(owner, session_file, peer_id, event)
+            except Exception as e:
+                print(f"Ошибка обработки сообщения процесса {index}: {e}")
+
+    def _forward(self, owner, session_file, peer_id, event):
+        inbox = self.inboxes.get(owner)
+        if inbox is None:
+            print(f"Процесс {owner} не запущен, сообщение {event['message_id']} от {peer_id} отброшено.")
+            return
+        try:
+            inbox.put((session_file, peer_id, event), timeout=SUBMIT_TIMEOUT)
+        except queue.Full:
+            print(f"Очередь процесса {owner} переполнена, сообщение {event['message_id']} от {peer_id} отброшено.")
+
+    def _check_processes(self):
+        now = time.monotonic()
+        for index in list(self.members):
+            process = self.processes[index]
+            if process.is_alive():
+                continue
+            # Сообщения, которые процесс не успел обработать, достанутся тому, кто получит их заново
+            try:
+                get_storage().release_claims(pid=process.pid)
+            except sqlite3.Error as e:
+                print(f"Ошибка снятия захватов процесса {index}: {e}")
+            crashes = self.crashes[index]
+            crashes.append(now)
+            while crashes and now - crashes[0] > SHARD_RESTART_WINDOW:
+                crashes.popleft()
+            if len(crashes) > SHARD_MAX_RESTARTS and len(self.members) > 1:
+                print(f"Процесс {index} падает слишком часто (код {process.exitcode}), его сессии перераспределяются.")
+                self.members.remove(index)
+                self.inboxes.pop(index, None)
+                self.outboxes.pop(index, None)
+                self.rebalance(force=True)
+            else:
+                print(f"Процесс {index} завершился (код {process.exitcode}), перезапуск.")
+                self._start(index)
+
+    def run(self):
+        global storage_batched
+        storage_batched = False
+        migrate_legacy_files(get_storage())
+        get_storage().commit()
+        migrate_xlsx_report()
+        if REPORTS_EXPORT_INTERVAL:
+            threading.Thread(target=reports_exporter, daemon=True).start()
+        self.assignment = self._assign()
+        for index in self.members:
+            self._start(index)
+        last_rescan = time.monotonic()
+        try:
             while True:
-                retries += 1
-                wait_time = min(backoff_factor * (2 ** retries), 60)
-                print(f"Попытка переподключения. Ожидание {wait_time} секунд.")
-                time.sleep(wait_time)
-                try:
-                    server_info = vk.messages.getLongPollServer(**longpoll_params)
-                    server = f"https://{server_info['server']}"
-                    key = server_info["key"]
-                    ts = server_info["ts"]
-                    print("Переподключение успешно.")
-                    break
-                except Exception as e:
-                    print(f"Ошибка переподключения: {e}")
+                time.sleep(SHARD_CHECK_INTERVAL)
+                self._check_processes()
+                if time.monotonic() - last_rescan >= SESSIONS_RESCAN_INTERVAL:
+                    self.rebalance()
+                    last_rescan = time.monotonic()
+        finally:
+            for process in self.processes.values():
+                process.terminate()
+
+# Основная функция
+def main():
+    parser = argparse.ArgumentParser(description="ИИ-агент для переписки ВКонтакте")
+    parser.add_argument("--all", action="store_true", help="запустить все сессии из папки Sessions без вопросов")
+    parser.add_argument("--session", metavar="ФАЙЛ", help="запустить одну сессию из папки Sessions без вопросов")
+    parser.add_argument("--sessions", metavar="ШАБЛОН", action="append",
+                        help="запустить сессии, подходящие под шаблон имени (например, 'group_*.ini'); можно указать несколько раз")
+    parser.add_argument("--processes", type=int, default=1, metavar="N",
+                        help="распределить сессии между N процессами под управлением супервизора")
+    parser.add_argument("--export-reports", action="store_true", help="выгрузить журнал отчётов в reports.xlsx и выйти")
+    args = parser.parse_args()
+
+    if args.export_reports:
+        migrate_xlsx_report()
+        export_reports()
+        return
+
+    if args.session:
+        session_name = os.path.basename(args.session)
+        if not os.path.exists(os.path.join(SESSIONS_DIR, session_name)):
+            print(f"Сессия {session_name} не найдена в папке Sessions.")
+            sys.exit(1)
+        patterns = [glob.escape(session_name)]
+    elif args.all or args.sessions:
+        patterns = args.sessions or ["*.ini"]
+    elif not sys.stdin.isatty():
+        # Запуск из супервизора или контейнера: ответить на вопросы выбора сессии некому
+        print("Не указаны сессии для запуска: используйте --session, --sessions или --all.")
+        sys.exit(1)
+    else:
+        session_file = scan_sessions()
+        if not session_file:
+            print("Ошибка выбора или создания сессии.")
+            return
+        patterns = [glob.escape(session_file)]
+    if args.processes > 1:
+        ShardSupervisor(patterns, args.processes).run()
+    else:
+        SessionEngine(patterns).run()
 
 if __name__ == "__main__":
     main()